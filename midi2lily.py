@@ -3,18 +3,128 @@ import sys
 import warnings
 import re
 import math
+import bisect
+import functools
+import numbers
 from fractions import Fraction
-from functools import reduce
 import argparse
+import os
+import io
+import time
+import hashlib
+import tempfile
+import mmap
+import select
+import collections
+import itertools
+import concurrent.futures
+import asyncio
+import json
+import base64
 import mido
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__version__ = "0.2.0"
+
+LILYPOND_VERSION = "2.19.48"
+
+# Counters and latency histograms of conversions. Counting is a dict
+# update and timing a stage a bisect, so the registry is always on. Work
+# done in worker processes is counted there and merged back (see
+# collect_metrics)
+class Metrics:
+
+    COUNTERS = {
+        'files': 'midi files converted',
+        'cache_hits': 'conversions read from the cache',
+        'notes': 'notes processed',
+        'chords': 'chords formed',
+        'polyphonic_contexts': 'polyphonic contexts created',
+        'voices': 'voices created in polyphonic contexts',
+        'quantize_adjustments': 'notes moved by quantization',
+        'warnings': 'warnings about the midi input',
+        'requests': 'requests to the conversion server',
+        'failures': 'conversions that failed',
+    }
+
+    # upper bounds of the latency histograms in seconds
+    BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.counters = dict.fromkeys(Metrics.COUNTERS, 0)
+        # stage: [count per bucket (the last one for slower), sum]
+        self.stages = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = [[0] * (len(Metrics.BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(Metrics.BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for stage, (counts, total) in other.stages.items():
+            histogram = self.stages.setdefault(stage, [[0] * (len(Metrics.BUCKETS) + 1), 0.0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+
+    def to_dict(self):
+        stages = {}
+        for stage, (counts, total) in self.stages.items():
+            buckets = {str(bound): count for bound, count in zip(Metrics.BUCKETS + ['+Inf'], itertools.accumulate(counts))}
+            stages[stage] = {'buckets': buckets, 'sum': total, 'count': sum(counts)}
+        return {'counters': dict(self.counters), 'stages': stages}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    # the text exposition format of prometheus
+    def to_prometheus(self, prefix='midi2lily'):
+        lines = []
+        for name, value in self.counters.items():
+            lines.append("# HELP {}_{}_total {}".format(prefix, name, Metrics.COUNTERS[name]))
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total {}".format(prefix, name, value))
+
+        lines.append("# HELP {}_stage_seconds time spent in each stage of a conversion".format(prefix))
+        lines.append("# TYPE {}_stage_seconds histogram".format(prefix))
+        for stage, histogram in self.to_dict()['stages'].items():
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, bound, count))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, histogram['sum']))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, histogram['count']))
+
+        return "\n".join(lines) + "\n"
+
+# the registry of this process
+metrics = Metrics()
+
+# Runs function in a worker process and returns its result together with
+# the metrics it recorded, for the parent to merge into its registry
+def collect_metrics(function, *args):
+    global metrics
+    saved, metrics = metrics, Metrics()
+    try:
+        return function(*args), metrics
+    finally:
+        metrics = saved
+
 # TODO Split into File render context and Staff Render context
 # TODO Move lots of decision making in __str__ to render context
 # TODO Split __str__ in two versions: one for context, one without
 class RenderContext:
 
     def __init__(self):
-        self.position = 0
+        self.position = Position(0, 1)
         self.time_signature = TimeSignature(4, 4)
         self.previous_pitch = None
         self.previous_duration = None
@@ -24,144 +134,404 @@ class RenderContext:
         # bad hack to get relative pitches for chords right. refactor
         self.previous_pitch = None
 
+    # the position may be set as a number, but is always kept as a Position
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, position):
+        self._position = as_position(position)
+
 # Every piece of Lilypond information is an expression
 class Expression:
-    
+
+    __slots__ = ()
+
+    # container this expression has been added to (if any). Containers
+    # cache their length and are notified when a child container changes
+    _parent = None
+
+    def _attach(self, parent):
+        self._parent = parent
+
+    # the length as a Duration on the tick grid. length() returns the same
+    # as a Fraction
+    def span(self):
+        return Duration(0, 1)
+
     def length(self):
-        return 0
+        return self.span().length()
+
+    def _child_length_changed(self, child, delta):
+        pass
+
+    def _child_pitch_changed(self, pitch, times):
+        pass
+
+    # yields the lilypond representation in pieces. Containers stream their
+    # children, so a document is never built as one big string
+    def chunks(self, context = None):
+        yield self.__str__(context)
+
+    # writes the lilypond representation to a file like object
+    def render(self, writer, context = None):
+        write_chunks(self.chunks(context), writer)
+
+# midi note numbers of the bits set in a pitch mask, lowest first
+def mask_pitches(mask):
+    while mask:
+        lowest_bit = mask & -mask
+        yield lowest_bit.bit_length() - 1
+        mask ^= lowest_bit
+
+# Running summary of the midi pitches used in an expression. It counts how
+# often every pitch occurs and keeps the distinct pitches as a bit mask, so
+# lowest, highest and average pitch are known without walking the tree
+class PitchSummary:
+
+    def __init__(self):
+        # occurrences of every pitch in use (most voices only use a few)
+        self.counts = {}
+        self.mask = 0
+        # sum and number of the distinct pitches
+        self.sum = 0
+        self.count = 0
+
+    # times can be negative to remove a pitch
+    def add(self, pitch, times=1):
+        before = self.counts.get(pitch, 0)
+
+        if before + times:
+            self.counts[pitch] = before + times
+        else:
+            del self.counts[pitch]
+
+        if before == 0:
+            self.mask |= 1 << pitch
+            self.sum += pitch
+            self.count += 1
+        elif before + times == 0:
+            self.mask &= ~(1 << pitch)
+            self.sum -= pitch
+            self.count -= 1
+
+    # distinct pitches, lowest first
+    def __iter__(self):
+        return mask_pitches(self.mask)
+
+    def __len__(self):
+        return self.count
+
+    def lowest(self, default=None):
+        return (self.mask & -self.mask).bit_length() - 1 if self.mask else default
+
+    def highest(self, default=None):
+        return self.mask.bit_length() - 1 if self.mask else default
+
+    def average(self, default=None):
+        return self.sum / self.count if self.count else default
 
 class TextExpression(Expression):
     
     def __init__(self, content):
         self.__content = content
         
-    def __str__(self):
+    def __str__(self, context = None):
         return self.__content
 
+# Chunked list of expressions that also keeps the end position of every
+# chunk. A position can be found by bisecting the chunk ends, and the list
+# can be split or joined by moving whole chunks instead of copying every
+# expression
+class ExpressionList:
+
+    chunk_size = 64
+
+    def __init__(self):
+        self._chunks = []
+        # end of every chunk, measured from the start of the list
+        self._ends = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def span(self):
+        return self._ends[-1] if self._ends else Duration(0, 1)
+
+    def first(self):
+        if self._chunks:
+            return self._chunks[0][0]
+
+    def last(self):
+        if self._chunks:
+            return self._chunks[-1][-1]
+
+    def append(self, expression):
+        if self._chunks and len(self._chunks[-1]) < self.chunk_size:
+            self._chunks[-1].append(expression)
+            self._ends[-1] += expression.span()
+        else:
+            self._chunks.append([expression])
+            self._ends.append(self.span() + expression.span())
+        self._count += 1
+
+    def pop(self):
+        chunk = self._chunks[-1]
+        expression = chunk.pop()
+        self._ends[-1] -= expression.span()
+        if not chunk:
+            self._chunks.pop()
+            self._ends.pop()
+        self._count -= 1
+        return expression
+
+    # moves all expressions of other to the end of this list
+    def extend(self, other):
+        assert(isinstance(other, ExpressionList))
+        offset = self.span()
+        chunks, ends = other._chunks, other._ends
+
+        # join small chunks at the seam, so repeated splitting and merging
+        # does not leave lots of tiny chunks behind
+        if chunks and self._chunks and len(self._chunks[-1]) + len(chunks[0]) <= self.chunk_size:
+            self._chunks[-1].extend(chunks[0])
+            self._ends[-1] = offset + ends[0]
+            chunks, ends = chunks[1:], ends[1:]
+
+        self._chunks.extend(chunks)
+        self._ends.extend(offset + end for end in ends)
+        self._count += other._count
+        other.__init__()
+
+    # an expression in the list changed its length (e.g. a voice that grows
+    # inside a polyphonic context). This usually is the last one
+    def child_length_changed(self, child, delta):
+        k = len(self._chunks) - 1
+        if child is not self.last():
+            while not any(expression is child for expression in self._chunks[k]):
+                k -= 1
+        for i in range(k, len(self._ends)):
+            self._ends[i] += delta
+
+    # removes all expressions that end after position from this list and
+    # returns them as a new list (or None if there are none)
+    def split_at(self, position):
+        k = bisect.bisect_right(self._ends, position)
+        if k == len(self._chunks):
+            return None
+
+        chunk = self._chunks[k]
+        start = self._ends[k - 1] if k > 0 else Duration(0, 1)
+        for i, expression in enumerate(chunk):
+            if start + expression.span() > position:
+                break
+            start += expression.span()
+
+        tail = ExpressionList()
+        tail._chunks = [chunk[i:]] + self._chunks[k + 1:]
+        tail._ends = [end - start for end in self._ends[k:]]
+        tail._count = sum(len(c) for c in tail._chunks)
+
+        del self._chunks[k:]
+        del self._ends[k:]
+        if i > 0:
+            self._chunks.append(chunk[:i])
+            self._ends.append(start)
+        self._count -= tail._count
+
+        return tail
+
 # Every expression can be contained in a compound expression
 # { }
 # TODO: split into rendering part and parse utility part
 class CompoundExpression(Expression):
 
     def __init__(self):
-        self._children = []
-    
+        self._children = ExpressionList()
+        self._pitches = PitchSummary()
+
     def add(self, child):
-        if type(child) is list:
-            self._children.extend(child)
-        else:
-            self._children.append(child)
-    
+        children = child if type(child) is list else [child]
+        span = self.span()
+        for expression in children:
+            expression._attach(self)
+            self._children.append(expression)
+            self._count_pitches(expression, 1)
+        self._length_changed(self.span() - span)
+
     def pop(self):
-        return self._children.pop()
+        span = self.span()
+        child = self._children.pop()
+        child._attach(None)
+        self._count_pitches(child, -1)
+        self._length_changed(self.span() - span)
+        return child
+
+    # adds (times = 1) or removes (times = -1) the pitches of a child to
+    # the pitch summary. Polyphonic contexts do not count towards the pitches
+    # of the expression that contains them
+    def _count_pitches(self, expression, times):
+        if isinstance(expression, Note):
+            self._child_pitch_changed(expression.pitch.pitch, times)
+        elif isinstance(expression, Chord):
+            for pitch in mask_pitches(expression.mask):
+                self._child_pitch_changed(pitch, times)
+        elif isinstance(expression, CompoundExpression):
+            summary = expression._pitches
+            for pitch in summary:
+                self._child_pitch_changed(pitch, times * summary.counts[pitch])
+
+    def _child_pitch_changed(self, pitch, times):
+        self._pitches.add(pitch, times)
+        if self._parent is not None:
+            self._parent._child_pitch_changed(pitch, times)
+
+    # the length is cached by the list of children, so only the parent
+    # needs to hear about a change
+    def _length_changed(self, delta):
+        if delta and self._parent is not None:
+            self._parent._child_length_changed(self, delta)
+
+    def _child_length_changed(self, child, delta):
+        self._children.child_length_changed(child, delta)
+        self._length_changed(delta)
+
+    # moves all expressions in children (an ExpressionList) to this expression
+    def _adopt(self, children):
+        span = self.span()
+        for expression in children:
+            expression._attach(self)
+            self._count_pitches(expression, 1)
+        self._children.extend(children)
+        self._length_changed(self.span() - span)
         
     def last(self):
-        if len(self._children) > 0:
-            return self._children[-1]
+        return self._children.last()
             
     def get_clef(self):
         if self.lowest_pitch() < 55:
             return 'bass'
 
-    def length(self):
-        lengths = list(map(lambda x: x.length(), self._children))
-        return sum(lengths)
+    def span(self):
+        return self._children.span()
         
     # removes all expressions after position from this expressions
     # returns a new expression that contains all
     def split_at(self, position):
-        length = 0
-                
-        for i, expression in enumerate(self._children):
-            length += expression.length()
-                
-            if length > position:
-                expression = CompoundExpression()
-                expression.add(self._children[i:])
-                self._children = self._children[0:i]
-                return expression
+        span = self.span()
+        tail = self._children.split_at(as_position(position))
+
+        if tail is not None:
+            for child in tail:
+                self._count_pitches(child, -1)
+            self._length_changed(self.span() - span)
+            expression = CompoundExpression()
+            expression._adopt(tail)
+            return expression
 
     def pitches(self):
-        pitches = set()
-        for expression in self._children:
-            if isinstance(expression, Note):
-                pitches.add(expression.pitch.pitch)
-            if isinstance(expression, Chord):
-                pitches.update(pitch.pitch for pitch in expression.pitches)
-            elif isinstance(expression, CompoundExpression):
-                pitches.update(pitch.pitch for pitch in expression.pitches())
-        return pitches
+        return set(self._pitches)
+
+    def pitch_summary(self):
+        return self._pitches
         
     def lowest_pitch(self):
-        return min(self.pitches(),default=108)
+        return self._pitches.lowest(default=108)
         
     def highest_pitch(self):
-        return max(self.pitches(),default=0)
+        return self._pitches.highest(default=0)
 
+    # moves all expressions of other to the end of this expression
     def merge(self, other):
         assert(isinstance(other, CompoundExpression))
-        self._children.extend(other._children)
+        self._adopt(other._children)
 
-    def __str__(self, context = None):
+    def chunks(self, context = None):
+        yield from self.opening_chunks(context, self.get_clef())
+        yield from self.children_chunks(context)
+        yield "}"
 
-        result = ""
+    # everything before the children, the clef is left out when it is None
+    def opening_chunks(self, context = None, clef = None):
 
         if isinstance(context, RenderContext) and context.relative:
             context.relative_base = 60
             context.previous_pitch = None
-            result += str(TextExpression("\\relative {} ".format(str(Pitch(context.relative_base)))))
+            yield "\\relative {} ".format(str(Pitch(context.relative_base)))
         
-        result += "{\n"
+        yield "{\n"
 
-        if self.get_clef() != None:
-            result += "\clef {}\n".format(self.get_clef())
-            
+        if clef != None:
+            yield "\\clef {}\n".format(clef)
 
+    def children_chunks(self, context = None):
         for expression in self._children:
-            result += expression.__str__(context) + " "
+            yield from expression.chunks(context)
+            yield " "
             
             # If previouse expression completely fills up this measure
             # add a measure sign (this is optional for lilypond, but will
             # be validated if it is there)
-            if isinstance(context, RenderContext) and context.position % Fraction(context.time_signature.numerator, context.time_signature.numerator) == 0:
-                result += "|\n"
-            
-        result += "}"
-        return result
+            if isinstance(context, RenderContext) and context.position.is_whole():
+                yield "|\n"
+
+    def __str__(self, context = None):
+        return "".join(self.chunks(context))
 
 # Container for multiple voices. Expected to be similar in length
 class PolyphonicContext(Expression):
 
     def __init__(self):
         self.__voices = []
+        self.__span = Duration(0, 1)
         
     def add(self, voice):
         assert(type(voice) == CompoundExpression)
+        voice._attach(self)
         self.__voices.append(voice)
+        self._child_length_changed(voice, voice.span())
             
     # TODO: Try to prevent access to voices
     def voices(self):
         return self.__voices
 
-    def length(self):
-        lengths = list(map(lambda x: x.length(), self.__voices))
-        longest = max(lengths, default=0)
-        return longest
+    def span(self):
+        return self.__span
+
+    # the length of a polyphonic context is the length of its longest voice.
+    # Voices only report a change, so only a shrinking voice needs a rescan
+    def _child_length_changed(self, child, delta):
+        if delta > 0:
+            longest = max(self.__span, child.span())
+        else:
+            longest = max((voice.span() for voice in self.__voices), default=Duration(0, 1))
+
+        delta = longest - self.__span
+        if delta:
+            self.__span = longest
+            if self._parent is not None:
+                self._parent._child_length_changed(self, delta)
 
     def is_balanced(self):
         # Checks if all children have equal length (this
         # means that the polyphonic context can be ended)
-        lengths = set(map(lambda x: x.length(), self.__voices))
+        lengths = set(map(lambda x: x.span(), self.__voices))
         return len(self.__voices) > 1 and len(lengths) == 1
         
     def close(self):
         
         # If unbalanced, add rests to the smallest 
-        longest = reduce(max, map(lambda x: x.length(), self.__voices))
+        longest = self.span()
         
         for voice in self.__voices:
-            if voice.length() < longest:
-                voice.add(Rest(Duration(longest - voice.length())))
+            if voice.span() < longest:
+                voice.add(Rest(longest - voice.span()))
         
     def merge(self, other):
 
@@ -177,58 +547,104 @@ class PolyphonicContext(Expression):
     def sort_function(e):
         # when printing a polyphonic context, sort by average pitch, so that 
         # highest voice is printed first and is drawn with stems up
-        pitches = e.pitches()
-        #assert(len(pitches) > 0)
-        if not pitches: return 0
-        return sum(pitches) / len(pitches)
+        return e.pitch_summary().average(default=0)
         
-    def __str__(self, context = None):
-        voices_representations = []
+    def chunks(self, context = None):
         
         if isinstance(context, RenderContext):
             local_start_position = context.position
+
+        yield "<<\n"
         
-        for voice in sorted(self.__voices, key=PolyphonicContext.sort_function, reverse=True):
+        for i, voice in enumerate(sorted(self.__voices, key=PolyphonicContext.sort_function, reverse=True)):
             # each voice starts at the same position
             if isinstance(context, RenderContext):
                 context.position = local_start_position
-            voices_representations.append(voice.__str__(context))
+            if i > 0:
+                yield "\n\\\\\n"
+            yield from voice.chunks(context)
         
-        return "<<\n"+ '\n\\\\\n'.join(voices_representations) + "\n>>"
-        
-        if isinstance(context, RenderContext):
-            context.position = local_start_position + self.length()
+        yield "\n>>"
+
+    def __str__(self, context = None):
+        return "".join(self.chunks(context))
     
 # A staff is a command followed by an expression that is contained in the staff
 class Staff(CompoundExpression):
 
     def __init__(self, name="new staff"):
         self.__name = name
+        self.quantization = QuantizationStats()
+        self.quantize_duration = None
         super().__init__()
 
-    def __str__(self, context = None):
+    def name(self):
+        return self.__name
+
+    # Renders the staff once and reuses the text from then on, as long as
+    # it is rendered in the same kind of context. The staff must not change
+    # after this
+    def freeze(self):
+        self._frozen = None
+        context = RenderContext()
+        self._frozen = (Staff.render_key(context), "".join(self.chunks(context)))
+
+    # the context settings a staff depends on, everything else is reset
+    # at the start of a staff
+    def render_key(context):
+        return (context.relative, context.time_signature.numerator, context.time_signature.denominator)
+
+    def chunks(self, context = None):
+
+        frozen = getattr(self, '_frozen', None)
+        if frozen is not None and isinstance(context, RenderContext) and frozen[0] == Staff.render_key(context):
+            yield frozen[1]
+            return
+
+        yield from super().chunks(context)
+
+    def opening_chunks(self, context = None, clef = None):
         
         if isinstance(context, RenderContext): 
             context.position = 0
             context.previous_pitch = None
             context.previous_duration = None
 
-        return "\\new Staff = \"{}\" ".format(self.__name) + super().__str__(context)
+        yield "\\new Staff = \"{}\" ".format(self.__name)
+        yield from super().opening_chunks(context, clef)
 
 # Groups a number of staves. A simple song is expected to have one staff group
 class StaffGroup(CompoundExpression):
 
-    def __str__(self, context = None):
-        return "\\new StaffGroup <<\n\n{}\n\n>>".format("\n\n".join([e.__str__(context) for e in self._children]))
+    def chunks(self, context = None):
+        yield "\\new StaffGroup <<\n\n"
+        for i, expression in enumerate(self._children):
+            if i > 0:
+                yield "\n\n"
+            yield from expression.chunks(context)
+        yield "\n\n>>"
 
-# Note, Rest, Chord should be immutable
-class Rest(Expression):
+# Note, Rest, Chord should be immutable. They never change their length,
+# so they do not need to know the container they are in
+class LeafExpression(Expression):
+
+    __slots__ = ('duration',)
+
+    def _attach(self, parent):
+        pass
+
+    def span(self):
+        return self.duration
+
+    def length(self):
+        return self.duration.length()
+
+class Rest(LeafExpression):
+
+    __slots__ = ()
     
     def __init__(self, duration):
         self.duration = duration
-    
-    def length(self):
-        return self.duration.length()
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.duration == other.duration
@@ -247,7 +663,9 @@ class Rest(Expression):
         
         return result
         
-class Note(Expression):
+class Note(LeafExpression):
+
+    __slots__ = ('pitch',)
     
     def get_from_midi_note(midi_note, context):
         pitch = Pitch(midi_note.pitch)
@@ -258,15 +676,17 @@ class Note(Expression):
         # TODO: rename to midinote
         self.pitch = pitch
         self.duration = duration
-        
-    def length(self):
-        return self.duration.length()
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.pitch == other.pitch and self.duration == other.duration
 
     def __hash__(self):
-        return hash(tuple(self.pitch)) + hash(self.duration)
+        return hash((self.pitch.pitch, self.duration))
+
+    # pitch as a chord mask (see Chord)
+    @property
+    def mask(self):
+        return 1 << self.pitch.pitch
 
     def __str__(self, context = None):
         assert(isinstance(self.duration, Duration))
@@ -276,7 +696,11 @@ class Note(Expression):
         return result
 
 # add helper method to create a chord from note + pitch or chord + pitch
-class Chord(Expression):
+# The pitches of a chord are kept as a 128 bit mask, bit n is set when
+# midi note n sounds
+class Chord(LeafExpression):
+
+    __slots__ = ('mask',)
     
     def construct_chord(note1, note2):
         
@@ -284,64 +708,78 @@ class Chord(Expression):
         assert(isinstance(note2, Note) or isinstance(note2, Chord))
         assert(note1.duration == note2.duration)
         
-        pitches = set()
-        
-        if isinstance(note1, Note):
-            pitches.add(note1.pitch)
-        else:
-            pitches.update(note1.pitches)
-        
-        if isinstance(note2, Note):
-            pitches.add(note2.pitch)
-        else:
-            pitches.update(note2.pitches)
-        
-        return Chord(pitches, note1.duration)
+        return Chord.from_mask(note1.mask | note2.mask, note1.duration)
+
+    def from_mask(mask, duration):
+        chord = Chord.__new__(Chord)
+        chord.mask = mask
+        chord.duration = duration
+        return chord
         
     def __init__(self, pitches, duration):
-        self.pitches = set(pitches)
+        self.mask = 0
+        for pitch in pitches:
+            self.mask |= 1 << pitch.pitch
         self.duration = duration
 
-    def length(self):
-        return self.duration.length()
+    # pitches of the chord, lowest first
+    @property
+    def pitches(self):
+        return [Pitch(pitch) for pitch in mask_pitches(self.mask)]
+
+    def lowest_pitch(self):
+        return Pitch((self.mask & -self.mask).bit_length() - 1)
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.pitches == other.pitches and self.duration == other.duration
+        return isinstance(other, self.__class__) and self.mask == other.mask and self.duration == other.duration
 
     def __hash__(self):
-        return hash(tuple(self.pitches)) + hash(self.duration)
+        return hash((self.mask, self.duration))
 
     def __str__(self, context = None):
         assert(isinstance(self.duration, Duration))
 
         pitches = []
 
-        #' '.join([p.__str__(context) for p in sorted(self.pitches)]))
         # bad hack to get relative pitches in a chord to play nice
-        for p in sorted(self.pitches):
+        for p in self.pitches:
             pitches.append(p.__str__(context))
-            #context.previous_pitch = p.pitch
 
         result = str("<{}>{}".format(' '.join(pitches), self.duration.__str__(context)))
         if isinstance(context, RenderContext): context.previous_duration = self.duration
         # bad hack to get relative pitches after a chord to play nice
-        if isinstance(context, RenderContext): context.previous_pitch = sorted(self.pitches)[0]
+        if isinstance(context, RenderContext): context.previous_pitch = self.lowest_pitch()
 
         return result
 
 # Converts a midi note number in a note name
 # TODO: enharmonics, respect key signature
+# Pitches are immutable and there are only 128 midi pitches, so
+# Pitch(60) always returns the same object
 class Pitch:
 
+    __slots__ = ('pitch',)
+
     # todo: flats
     noteNames = [ 'c', 'cis', 'd', 'dis', 'e', 'f', 'fis', 'g', 'gis', 'a', 'ais', 'b' ]
 
-    def __init__(self, pitch):
+    _pool = []
+
+    def __new__(cls, pitch):
+        if type(pitch) is int and 0 <= pitch < len(Pitch._pool):
+            return Pitch._pool[pitch]
+
+        self = super().__new__(cls)
         # TODO: Rename to midi note number
         self.pitch = pitch
+        return self
+
+    # unpickled pitches come from the pool as well
+    def __reduce__(self):
+        return (Pitch, (self.pitch,))
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.pitch == other.pitch
+        return self is other or (isinstance(other, self.__class__) and self.pitch == other.pitch)
         
     def __lt__(self, other):
         return isinstance(other, self.__class__) and self.pitch < other.pitch
@@ -387,109 +825,193 @@ class Pitch:
             
         return self.noteNames[self.pitch % 12] + octave_string
         
-# A duration measured as a fraction
-# also doubles as position
-# TODO: Also store midi time/ticks?
+Pitch._pool = [Pitch(pitch) for pitch in range(128)]
+
+# A duration measured in whole notes, also doubles as position. It is kept
+# as a whole number of ticks on a grid of `resolution` ticks per whole note
+# (ticks_per_beat * time signature denominator for midi input), so
+# arithmetic and comparisons on the same grid are plain integer operations.
+# A Fraction is only built when one is asked for (length())
 class Position:
+
+    __slots__ = ('_ticks', '_resolution', '_fraction')
     
     def get_position(ticks, ticks_per_beat, denominator):
-        beatFraction = Fraction(ticks, ticks_per_beat)
-        return Position(Fraction(beatFraction.numerator, beatFraction.denominator * denominator))
-
-    def __init__(self, fraction):
-        assert(isinstance(fraction, Fraction))
-        self._fraction = fraction
+        return Position(ticks, ticks_per_beat * denominator)
+
+    # Position(Fraction(3, 4)) or Position(3, 4)
+    def __init__(self, ticks, resolution = None):
+        if resolution is None:
+            assert(isinstance(ticks, Fraction))
+            ticks, resolution = ticks.numerator, ticks.denominator
+        self._ticks = ticks
+        self._resolution = resolution
+        self._fraction = None
     
     # todo: misnomer for position
     def length(self):
+        if self._fraction is None:
+            self._fraction = Fraction(self._ticks, self._resolution)
         return self._fraction
 
+    # ticks of self and other on a common grid
+    def _align(self, other):
+        if self._resolution == other._resolution:
+            return self._ticks, other._ticks, self._resolution
+        resolution = self._resolution * other._resolution // math.gcd(self._resolution, other._resolution)
+        return self._ticks * (resolution // self._resolution), other._ticks * (resolution // other._resolution), resolution
+
+    def __add__(self, other):
+        a, b, resolution = self._align(as_position(other))
+        return self.__class__(a + b, resolution)
+
+    # the distance between two positions is a duration
+    def __sub__(self, other):
+        a, b, resolution = self._align(as_position(other))
+        return Duration(a - b, resolution)
+
+    def __mod__(self, other):
+        a, b, resolution = self._align(as_position(other))
+        return self.__class__(a % b, resolution)
+
+    def __bool__(self):
+        return self._ticks != 0
+
+    # True if this position is at the start of a whole note
+    def is_whole(self):
+        return self._ticks % self._resolution == 0
+
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.length() == other.length()
+        if isinstance(other, Position):
+            if not isinstance(other, self.__class__):
+                return False
+        elif not isinstance(other, numbers.Rational):
+            return False
+        other = as_position(other)
+        if self._resolution == other._resolution:
+            return self._ticks == other._ticks
+        return self._ticks * other._resolution == other._ticks * self._resolution
         
     def __lt__(self, other):
-        return isinstance(other, self.__class__) and self.length() < other.length()
+        other = as_position(other)
+        if self._resolution == other._resolution:
+            return self._ticks < other._ticks
+        return self._ticks * other._resolution < other._ticks * self._resolution
     
     def __le__(self, other):
-        return isinstance(other, self.__class__) and self.length() <= other.length()
+        other = as_position(other)
+        if self._resolution == other._resolution:
+            return self._ticks <= other._ticks
+        return self._ticks * other._resolution <= other._ticks * self._resolution
 
     def __gt__(self, other):
-        return isinstance(other, self.__class__) and self.length() > other.length()
+        other = as_position(other)
+        if self._resolution == other._resolution:
+            return self._ticks > other._ticks
+        return self._ticks * other._resolution > other._ticks * self._resolution
 
     def __ge__(self, other):
-        return isinstance(other, self.__class__) and self.length() >= other.length()
+        other = as_position(other)
+        if self._resolution == other._resolution:
+            return self._ticks >= other._ticks
+        return self._ticks * other._resolution >= other._ticks * self._resolution
     
     def __hash__(self):
-        return hash(self._fraction)
+        return hash(self.length())
 
     def __str__(self):
-        return "measure {}, beat {}".format((self._fraction.numerator // self._fraction.denominator), (self._fraction.numerator % self._fraction.denominator))
+        fraction = self.length()
+        return "measure {}, beat {}".format((fraction.numerator // fraction.denominator), (fraction.numerator % fraction.denominator))
+
+# numbers (ints, fractions) are accepted wherever positions are compared
+def as_position(value):
+    if isinstance(value, Position):
+        return value
+    return Position(Fraction(value))
 
 class Duration(Position):
 
+    __slots__ = ()
+
+    # durations are immutable and a piece only uses a handful of different
+    # ones, so every note with the same length shares one Duration
+    @functools.lru_cache(maxsize=4096)
     def get_duration(ticks, ticks_per_beat, denominator):
-        beatFraction = Fraction(ticks, ticks_per_beat)
-        return Duration(Fraction(beatFraction.numerator, beatFraction.denominator * denominator))
+        return Duration(ticks, ticks_per_beat * denominator)
         
     def get_ticks(self, ticks_per_beat, denominator):
-        return int(self._fraction.numerator * ticks_per_beat * ( denominator / self._fraction.denominator ))
+        return self._ticks * ticks_per_beat * denominator // self._resolution
         
     def can_be_expresses_as_simple_note(self):
-        return self._fraction.numerator == 1
+        return self.length().numerator == 1
 
     def can_be_expresses_as_dotted_note(self):
-        return (self._fraction.denominator > 1) and (((self._fraction.numerator + 1) % 4) == 0)
-        
-    def length(self):
-        return self._fraction
+        numerator = self.length().numerator
+        return (self.length().denominator > 1) and numerator > 1 and (numerator & (numerator + 1)) == 0
 
     def __str__(self, context = None, force_expression = False):
         
         if isinstance(context, RenderContext):
 
             # Check if note crosses a measure (TODO: Also check hidden barlines to cater for readable syncopation)
-            remaining_space_in_measure = (context.time_signature.get_measure_length() - context.position) % context.time_signature.get_measure_length()
+            measure = context.time_signature.get_measure_span()
+            remaining_space_in_measure = (measure - context.position) % measure
 
-            if remaining_space_in_measure > 0 and remaining_space_in_measure < self.length():
-                duration1 = Duration(remaining_space_in_measure)
-                duration2 = Duration(self.length() - remaining_space_in_measure)
+            if remaining_space_in_measure and remaining_space_in_measure < self:
+                duration1 = remaining_space_in_measure
+                duration2 = self - remaining_space_in_measure
 
                 return "~ | ".join([duration1.__str__(context, True), duration2.__str__(context, True)])
             
             # type setting optimization: If this note has
             # the same duration as the previous note, you can 
             # omit the duration
-            context.position += self.length()
+            context.position += self
 
             previous_duration = context.previous_duration
             context.previous_duration = self
             if not force_expression and self == previous_duration:
                 return ""
 
-        if (self.can_be_expresses_as_simple_note()):
-            # simple duration
-            return str(self._fraction.denominator)
-        elif (self.can_be_expresses_as_dotted_note()):
-            # dotted duration
-            wholeNote = Fraction((self._fraction.numerator + 1)//2, self._fraction.denominator)
-            numberOfDots = int(math.log(self._fraction.numerator + 1,2)-1)
-            return str(wholeNote.denominator) + "." * numberOfDots
-        else:
-            # bruteforce the biggest whole duration we can find
-            i = 1
-            while i < self._fraction.numerator:
-                wholeNote = Fraction(self._fraction.numerator - i, self._fraction.denominator)
-                if wholeNote.numerator == 1:
-                    remainder = Duration(self._fraction - wholeNote)
-                    return str(wholeNote.denominator) + "~ " + str(remainder)
-                i += 1
-
-            return "should not happen"
+        return Duration.format(self._ticks, self._resolution)
+
+    # lilypond representation of a duration of ticks / resolution whole
+    # notes. Formatted strings are remembered for all durations in a run
+    @functools.lru_cache(maxsize=1024)
+    def format(ticks, resolution):
+        if ticks <= 0:
+            raise ValueError("a duration of {}/{} can not be written as notes".format(ticks, resolution))
+
+        divisor = math.gcd(ticks, resolution)
+        numerator, denominator = ticks // divisor, resolution // divisor
+
+        # denominator = odd * 2 ** exponent. The odd part is the tuplet the
+        # notes belong to (1 for regular notes), after taking it out the
+        # duration is a binary number of whole notes: every run of ones in
+        # it is one simple or dotted note
+        exponent = (denominator & -denominator).bit_length() - 1
+        odd = denominator >> exponent
+        values = []
+
+        # all but the last whole note are written as separate whole notes
+        wholes = numerator >> exponent
+        if wholes > 1:
+            values.extend([str(odd)] * (wholes - 1))
+            numerator -= (wholes - 1) << exponent
+
+        while numerator:
+            top = numerator.bit_length() - 1
+            # lowest bit of the run of ones that starts at top
+            bottom = (~numerator & ((1 << top) - 1)).bit_length()
+            values.append(str(odd << (exponent - top)) + "." * (top - bottom))
+            numerator &= (1 << bottom) - 1
+
+        return "~ ".join(values)
 
 # Can a file have multiple expressions, or just a single one?
 class File:
 
-    def __init__(self, version="2.19.48"):
+    def __init__(self, version=LILYPOND_VERSION):
         self.__children = []
         self.__version = version
         
@@ -509,17 +1031,45 @@ class File:
     def expressions(self):
         return self.__children
 
-    def __str__(self):
+    def staves(self):
+        for expression in self.__children:
+            if isinstance(expression, Staff):
+                yield expression
+            elif isinstance(expression, StaffGroup):
+                yield from expression._children
+
+    def chunks(self):
         
         context = RenderContext()
-        result = "\\version \"{}\"".format(self.__version)
+        yield "\\version \"{}\"".format(self.__version)
 
         if (self.__children != []):
-            result += "\n\n"
+            yield "\n\n"
             for expression in self.__children:
-                result += expression.__str__(context)
+                yield from expression.chunks(context)
 
-        return result
+    # writes the lilypond file to a file like object (e.g. sys.stdout)
+    # without building the whole document in memory
+    def render(self, writer):
+        write_chunks(self.chunks(), writer)
+
+    def __str__(self):
+        return "".join(self.chunks())
+
+# The lilypond text of a conversion, read back from a ConversionCache
+class CachedFile:
+
+    def __init__(self, text):
+        self.text = text
+
+    def chunks(self):
+        yield self.text
+
+    def render(self, writer):
+        writer.write(self.text)
+
+    def __str__(self):
+        return self.text
 
 class TimeSignature(Expression):
     
@@ -529,16 +1079,121 @@ class TimeSignature(Expression):
         
     def get_measure_length(self):
         return Fraction(self.numerator, self.denominator)
+
+    def get_measure_span(self):
+        return Duration(self.numerator, self.denominator)
         
     def __str__(self, context = None):
         if isinstance(context, ParseContext): context.time_signature = self
         return "\\time {}/{}".format(self.numerator, self.denominator)
 
+# writes chunks of text to writer. Small chunks are collected first, so the
+# writer is not called for every single note
+def write_chunks(chunks, writer, buffer_size=65536):
+    buffer = []
+    size = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            writer.write("".join(buffer))
+            buffer = []
+            size = 0
+
+    if buffer:
+        writer.write("".join(buffer))
+
 def quantize(time, resolution_in_ticks):
     return int(round(time / resolution_in_ticks) * resolution_in_ticks)
 
+# Same as quantize for a numpy array of times. Both round halves to even
+def quantize_array(times, resolution_in_ticks):
+    return (numpy.round(times / resolution_in_ticks) * resolution_in_ticks).astype(times.dtype)
+
+# Quantizes the start and end of an array of notes (see columnar_midi_notes)
+# in place. Like MidiNote.quantize, a note never gets shorter than the
+# resolution. Returns the quantization errors
+def quantize_midi_notes(midi_notes, resolution_in_ticks):
+    start = quantize_array(midi_notes['start'], resolution_in_ticks)
+    end = numpy.maximum(start + resolution_in_ticks, quantize_array(midi_notes['end'], resolution_in_ticks))
+
+    stats = QuantizationStats()
+    stats.add_arrays(start - midi_notes['start'], end - midi_notes['end'])
+
+    midi_notes['start'] = start
+    midi_notes['end'] = end
+
+    return stats
+
+# Pass as quantize_duration to let convert pick a grid for every track
+AUTO_QUANTIZE = 'auto'
+
+# Grids tried by automatic quantization: 8th, 16th, 32nd notes and 8th and
+# 16th triplets
+AUTO_QUANTIZE_DENOMINATORS = [8, 16, 32, 12, 24]
+
+# Weight of the fineness of a grid against its quantization error. Notes at
+# random positions have a mean error of a quarter grid step, which makes
+# grids of about a 22nd note the best fit for notes that follow no grid
+AUTO_QUANTIZE_PENALTY = 1 / 2048
+
+# Picks the quantization grid that fits the starts and ends of an array of
+# notes best. Every grid gets the mean distance of the note edges to the
+# grid plus a penalty for the number of grid steps in a whole note (both in
+# whole notes), all grids are scored at once. Returns None without notes
+def choose_quantize_duration(midi_notes, ticks_per_beat, denominator):
+    if not len(midi_notes):
+        return None
+
+    durations = [Duration(Fraction(1, d)) for d in AUTO_QUANTIZE_DENOMINATORS]
+    resolutions = numpy.array([duration.get_ticks(ticks_per_beat, denominator) for duration in durations])[:, numpy.newaxis]
+    times = numpy.concatenate((midi_notes['start'], midi_notes['end']))[numpy.newaxis, :]
+
+    errors = numpy.abs(times - numpy.round(times / resolutions) * resolutions).mean(axis=1)
+    scores = errors / (ticks_per_beat * denominator) + AUTO_QUANTIZE_PENALTY * numpy.array(AUTO_QUANTIZE_DENOMINATORS)
+
+    return durations[int(numpy.argmin(scores))]
+
+# How far quantization moved the starts and ends of notes, in ticks
+class QuantizationStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total_error = 0
+        self.max_error = 0
+
+    def add(self, start_error, end_error):
+        self.count += 1
+        if start_error or end_error:
+            metrics.count('quantize_adjustments')
+        self.total_error += abs(start_error) + abs(end_error)
+        self.max_error = max(self.max_error, abs(start_error), abs(end_error))
+
+    def add_arrays(self, start_errors, end_errors):
+        if len(start_errors):
+            start_errors, end_errors = numpy.abs(start_errors), numpy.abs(end_errors)
+            self.count += len(start_errors)
+            metrics.count('quantize_adjustments', int(numpy.count_nonzero(start_errors + end_errors)))
+            self.total_error += int(start_errors.sum() + end_errors.sum())
+            self.max_error = max(self.max_error, int(start_errors.max()), int(end_errors.max()))
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_error += other.total_error
+        self.max_error = max(self.max_error, other.max_error)
+
+    # average error of a start or an end
+    def mean_error(self):
+        return self.total_error / (2 * self.count) if self.count else 0
+
+    def __str__(self):
+        return "{} notes, mean error {:.1f} ticks, max error {} ticks".format(self.count, self.mean_error(), self.max_error)
+
 # a representation of midi note as start, end and pitch  
 class MidiNote:
+
+    __slots__ = ('start', 'end', 'pitch')
     
     def __init__(self, start, end, pitch):
         assert(isinstance(start, int))
@@ -558,7 +1213,7 @@ class MidiNote:
         return isinstance(other, self.__class__) and self.start == other.start and self.end == other.end and self.pitch == other.pitch
         
     def __hash__(self):
-        return hash(str(self.start) + str(self.end) + str(self.pitch))
+        return hash((self.start, self.end, self.pitch))
 
 # TODO: Split into file parse context that does not reset
 #       and track parse context that resets for every track   
@@ -574,6 +1229,7 @@ class ParseContext:
         self.ticks_per_beat = 0
         self.active_pitches = {}
         self.quantize_ticks = None
+        self.quantization = None
         
 def is_note_on_message(msg):
     return msg.type == 'note_on' and msg.velocity > 0
@@ -593,8 +1249,7 @@ def convert_to_midi_note(msg, context):
     start_position = 0
     
     if msg.note not in context.active_pitches:
-        position = Position.get_position(quantize(context.position, context.quantize_ticks), context.ticks_per_beat, context.time_signature.denominator)
-        warnings.warn("note-off message with no corresponding note-on message found: pitch: {}, time: {} @ {} in track '{}'".format(Pitch(msg.note), msg.time, position, context.track.name))
+        warn_unpaired_note_off(msg.note, msg.time, context.position, context)
     else:
         start_position = context.active_pitches.pop(msg.note)
     
@@ -603,10 +1258,203 @@ def convert_to_midi_note(msg, context):
     
     if context.quantize_ticks:
         midi_note.quantize(context.quantize_ticks)
+        if context.quantization is not None:
+            context.quantization.add(midi_note.start - start_position, midi_note.end - context.position)
     
     return midi_note
 
+def warn_unpaired_note_off(pitch, time, position, context):
+    metrics.count('warnings')
+    ticks = quantize(position, context.quantize_ticks) if context.quantize_ticks else position
+    position = Position.get_position(ticks, context.ticks_per_beat, context.time_signature.denominator)
+    warnings.warn("note-off message with no corresponding note-on message found: pitch: {}, time: {} @ {} in track '{}'".format(Pitch(pitch), time, position, context.track.name))
+
+def time_signature_handler(msg, context, ticks_per_beat, quantize_duration):
+    # for now, ignore changes in time signature mid song
+    if context.time_signature == None:
+        context.time_signature = TimeSignature(msg.numerator, msg.denominator)
+        context.ticks_per_beat = ticks_per_beat
+        if isinstance(quantize_duration, Duration):
+            context.quantize_ticks = quantize_duration.get_ticks(ticks_per_beat, msg.denominator)
+
+# Message kinds in the columnar representation of a track
+OTHER_MESSAGE, NOTE_ON_MESSAGE, NOTE_OFF_MESSAGE = range(3)
+
+MESSAGE_KINDS = { 'note_on': NOTE_ON_MESSAGE, 'note_off': NOTE_OFF_MESSAGE }
+
+# Reads the messages of a track into numpy arrays: delta time, absolute
+# tick, message kind, note and velocity. Also returns the first time
+# signature message of the track (or None)
+def track_columns(track):
+    time_signatures = []
+
+    def rows():
+        for msg in track:
+            kind = MESSAGE_KINDS.get(msg.type, OTHER_MESSAGE)
+            if kind:
+                yield (msg.time, kind, msg.note, msg.velocity)
+            else:
+                if msg.type == 'time_signature' and not time_signatures:
+                    time_signatures.append(msg)
+                yield (msg.time, kind, 0, 0)
+
+    columns = numpy.fromiter(rows(), dtype=[('time', 'i8'), ('kind', 'i1'), ('note', 'i2'), ('velocity', 'i2')])
+    tick = numpy.cumsum(columns['time'])
+
+    return columns, tick, time_signatures[0] if time_signatures else None
+
+# Pairs all note-on and note-off messages of a track at once. A note-off
+# belongs to the last note-on of the same pitch before it, unless another
+# note-off came in between, in other words, when it directly follows a
+# note-on in the events of its pitch. Returns one row per note-off, in
+# the order of the note-offs. Unpaired note-offs start at 0
+def columnar_midi_notes(columns, tick):
+    kind, note, velocity = columns['kind'], columns['note'], columns['velocity']
+    note_on = (kind == NOTE_ON_MESSAGE) & (velocity > 0)
+    note_off = (kind == NOTE_OFF_MESSAGE) | ((kind == NOTE_ON_MESSAGE) & (velocity == 0))
+
+    # note events grouped by pitch, in order of time within every pitch
+    index = numpy.flatnonzero(note_on | note_off)
+    index = index[numpy.lexsort((index, note[index]))]
+
+    previous = numpy.roll(index, 1)
+    paired = note_on[previous] & (note[previous] == note[index])
+    if len(index): paired[0] = False
+
+    # back to the order of the note-offs
+    is_off = note_off[index]
+    order = numpy.argsort(index[is_off], kind='stable')
+    off, previous, paired = index[is_off][order], previous[is_off][order], paired[is_off][order]
+
+    midi_notes = numpy.empty(len(off), dtype=[('start', 'i8'), ('end', 'i8'), ('pitch', 'i2'), ('paired', '?'), ('time', 'i8')])
+    midi_notes['start'] = numpy.where(paired, tick[previous], 0)
+    midi_notes['end'] = tick[off]
+    midi_notes['pitch'] = note[off]
+    midi_notes['paired'] = paired
+    midi_notes['time'] = columns['time'][off]
+
+    return midi_notes
+
+# Same as walking the messages of a track through note_on_handler and
+# note_off_handler, but pairs the notes of the whole track in bulk
+def convert_track_columns(track, context, ticks_per_beat, quantize_duration, jobs=1):
+    midi_notes = track_midi_notes(track, context, ticks_per_beat, quantize_duration)
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            handle_midi_notes_in_segments(midi_notes, context, jobs, executor.map)
+    else:
+        handle_midi_notes(midi_notes, context)
+
+# The notes of a track as an array (see columnar_midi_notes), quantized
+# when context asks for it. Warns about note-offs without a note-on
+def track_midi_notes(track, context, ticks_per_beat, quantize_duration):
+    columns, tick, time_signature = track_columns(track)
+
+    if time_signature is not None:
+        time_signature_handler(time_signature, context, ticks_per_beat, quantize_duration)
+
+    midi_notes = columnar_midi_notes(columns, tick)
+
+    if quantize_duration == AUTO_QUANTIZE and context.time_signature is not None:
+        quantize_duration = choose_quantize_duration(midi_notes, ticks_per_beat, context.time_signature.denominator)
+        context.quantize_ticks = quantize_duration.get_ticks(ticks_per_beat, context.time_signature.denominator) if quantize_duration else None
+        if context.staff is not None:
+            context.staff.quantize_duration = quantize_duration
+
+    for midi_note in midi_notes[~midi_notes['paired']]:
+        warn_unpaired_note_off(int(midi_note['pitch']), int(midi_note['time']), int(midi_note['end']), context)
+
+    if context.quantize_ticks:
+        stats = quantize_midi_notes(midi_notes, context.quantize_ticks)
+        if context.quantization is not None:
+            context.quantization.merge(stats)
+
+    context.position = int(tick[-1]) if len(tick) else 0
+
+    return midi_notes
+
+def handle_midi_notes(midi_notes, context):
+    for start, end, pitch in zip(midi_notes['start'].tolist(), midi_notes['end'].tolist(), midi_notes['pitch'].tolist()):
+        handle_midi_note(MidiNote(start, end, pitch), context)
+
+# Segments shorter than this are not worth a worker process
+MIN_SEGMENT_NOTES = 2000
+
+# Splits an array of notes (in the order they are handled) into at most
+# segments parts at moments of silence: every note before a cut ends before
+# any note after it starts. Returns the index of the first note of every
+# part, the first one is always 0
+def silence_cuts(midi_notes, segments):
+    count = len(midi_notes)
+    if segments < 2 or count < 2 * MIN_SEGMENT_NOTES:
+        return [0]
+
+    ends = numpy.maximum.accumulate(midi_notes['end'])
+    starts = numpy.minimum.accumulate(midi_notes['start'][::-1])[::-1]
+    cuts = numpy.flatnonzero(ends[:-1] <= starts[1:]) + 1
+
+    # the silence closest to an even split of the notes
+    result = [0]
+    for k in range(1, segments):
+        if not len(cuts): break
+        target = count * k // segments
+        i = numpy.searchsorted(cuts, target)
+        candidates = cuts[max(0, i - 1):i + 1]
+        cut = int(candidates[numpy.argmin(numpy.abs(candidates - target))])
+        if cut - result[-1] >= MIN_SEGMENT_NOTES and count - cut >= MIN_SEGMENT_NOTES:
+            result.append(cut)
+
+    return result
+
+# Converts a segment of notes into a staff of its own, as if the segment
+# was a track that starts at base ticks
+def convert_segment(segment):
+    starts, ends, pitches, base, time_signature, ticks_per_beat = segment
+
+    context = ParseContext()
+    context.time_signature = time_signature
+    context.ticks_per_beat = ticks_per_beat
+    context.staff = Staff()
+
+    for start, end, pitch in zip(starts, ends, pitches):
+        handle_midi_note(MidiNote(start - base, end - base, pitch), context)
+
+    if context.polyphonic_context:
+        context.polyphonic_context.close()
+
+    return context.staff
+
+# Same as handle_midi_notes, but converts the segments between silences
+# separately (map runs convert_segment, e.g. on a process pool) and appends
+# them to context.staff. A segment starts at the end of the notes before
+# it, which is where a sequential conversion would have put the first note
+# of the segment. The one thing a segment can not know is whether it has
+# to join the polyphonic context at the end of the segment before it. In
+# that case, or when a segment does not end where the next one expects it
+# to, the remaining notes are converted sequentially
+def handle_midi_notes_in_segments(midi_notes, context, segments, map=map):
+    cuts = silence_cuts(midi_notes, segments)
+    if len(cuts) < 2:
+        return handle_midi_notes(midi_notes, context)
+
+    ends = numpy.maximum.accumulate(midi_notes['end'])
+    bases = [0] + [int(ends[cut - 1]) for cut in cuts[1:]]
+    bounds = list(zip(cuts, cuts[1:] + [len(midi_notes)]))
+
+    work = ((midi_notes['start'][begin:end].tolist(), midi_notes['end'][begin:end].tolist(), midi_notes['pitch'][begin:end].tolist(), base, context.time_signature, context.ticks_per_beat) for (begin, end), base in zip(bounds, bases))
+
+    staff = context.staff
+    for (begin, end), base, (segment, segment_metrics) in zip(bounds, bases, map(functools.partial(collect_metrics, convert_segment), work)):
+        expected_span = Duration.get_duration(base, context.ticks_per_beat, context.time_signature.denominator)
+        if staff.span() != expected_span or (isinstance(staff.last(), PolyphonicContext) and isinstance(segment._children.first(), PolyphonicContext)):
+            handle_midi_notes(midi_notes[begin:], context)
+            break
+        staff._adopt(segment._children)
+        metrics.merge(segment_metrics)
+
 def handle_midi_note(midi_note, context):
+    metrics.count('notes')
     note = Note.get_from_midi_note(midi_note, context)
     start = Position.get_position(midi_note.start, context.ticks_per_beat, context.time_signature.denominator)
     
@@ -622,7 +1470,7 @@ def handle_midi_note(midi_note, context):
     # try to fit the note into any of the children of the polyphonic context
     for expression in context.polyphonic_context.voices():
         # recalculate start in terms of expression
-        local_start = Position(start.length() - (context.staff.length() - context.polyphonic_context.length()))
+        local_start = start - (context.staff.span() - context.polyphonic_context.span())
         note_fits = fit_note_in_expression(note, local_start, expression)
 
         if note_fits:
@@ -632,8 +1480,9 @@ def handle_midi_note(midi_note, context):
         
     # if we arrive here the note does not fit in any of the existing voices, create a new one
     expression = CompoundExpression()
+    metrics.count('voices')
     context.polyphonic_context.add(expression)
-    local_start = Position(start.length() - (context.staff.length() - context.polyphonic_context.length()))
+    local_start = start - (context.staff.span() - context.polyphonic_context.span())
 
     if fit_note_in_expression(note, local_start, expression): return
     
@@ -641,7 +1490,7 @@ def setup_polyphonic_context(expression, start):
     polyphonic_context = PolyphonicContext()
     
     if not isinstance(expression.last(), PolyphonicContext):
-        polyphonic_context.add(expression.split_at(start.length()))
+        polyphonic_context.add(expression.split_at(start))
    
     # check if last expression is a polyphonic expression. In that
     # case, do not create a new one, but append to existing one
@@ -651,6 +1500,8 @@ def setup_polyphonic_context(expression, start):
         return existing_polyphonic_context
     else:
         expression.add(polyphonic_context)
+        metrics.count('polyphonic_contexts')
+        metrics.count('voices', len(polyphonic_context.voices()))
         return polyphonic_context
    
 # TODO: Add to expression class
@@ -658,10 +1509,10 @@ def fit_note_in_expression(note, start, expression):
     # check if this note can be added to the score as a simple note (no polyphony, no chord)
 
     # if gap add rest
-    if (start.length() > expression.length()):
-        expression.add(Rest(Duration(start.length() - expression.length())))
+    if (start > expression.span()):
+        expression.add(Rest(start - expression.span()))
 
-    if (start.length() >= expression.length()):
+    if (start >= expression.span()):
         expression.add(note)
         return True
     
@@ -670,82 +1521,1254 @@ def fit_note_in_expression(note, start, expression):
     
     # TODO: refactor in can_be_added_to and replace with
     if previous_note != None and (isinstance(previous_note, Note) or isinstance(previous_note, Chord)):
-        start_of_previous_note = expression.length() - previous_note.length()
+        start_of_previous_note = expression.span() - previous_note.span()
     
-        if (start.length() >= start_of_previous_note) and (note.duration == previous_note.duration):
+        if (start >= start_of_previous_note) and (note.duration == previous_note.duration):
             chord = Chord.construct_chord(note, previous_note)
+            metrics.count('chords')
             expression.pop()
             expression.add(chord)
             return True
       
-def convert(midifile, quantize_duration=None):
-
-    file = File()
-    staffGroup = None
+# Events of a track read by SmfTrack. Like mido messages, they have a type
+# and the ticks since the previous event as time
+NoteEvent = collections.namedtuple('NoteEvent', ['type', 'time', 'note', 'velocity'])
+TimeSignatureEvent = collections.namedtuple('TimeSignatureEvent', ['type', 'time', 'numerator', 'denominator'])
+TrackNameEvent = collections.namedtuple('TrackNameEvent', ['type', 'time', 'name'])
+
+# number of data bytes that follow a status byte
+CHANNEL_MESSAGE_LENGTHS = { 0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2 }
+SYSTEM_MESSAGE_LENGTHS = { 0xF1: 1, 0xF2: 2, 0xF3: 1 }
+
+# reads a variable length number, returns it and the offset after it
+def read_variable_int(data, offset):
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, offset
+
+# A track of a standard midi file. The events are decoded while iterating,
+# only note on/off, time signature and track name events are produced.
+# The time of skipped events is added to the next event
+class SmfTrack:
+
+    def __init__(self, data):
+        self.data = data
+        self._name = None
+
+    # tracks are sent to worker processes as plain bytes
+    def __reduce__(self):
+        return (SmfTrack, (bytes(self.data),))
+
+    # the first track name event, like mido. A track without one is
+    # decoded to its end
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = next((event.name for event in self if event.type == 'track_name'), '')
+        return self._name
+
+    # the name when it comes before time passes or a note is played (the
+    # setup of the channel can come first), as it does in most files, or
+    # None. The rest of the track is not decoded
+    def leading_name(self):
+        if self._name is not None:
+            return self._name
+        return next((event.name for event in self.events(leading=True) if event.type == 'track_name'), None)
+
+    def __iter__(self):
+        return self.events()
+
+    # with leading, only the events at the start of the track, before time
+    # passes or a note is played
+    def events(self, leading=False):
+        data = self.data
+        end = len(data)
+        offset = 0
+        time = 0
+        running_status = None
+
+        while offset < end:
+            delta, offset = read_variable_int(data, offset)
+            if leading and delta:
+                return
+            time += delta
+
+            status = data[offset]
+            if status < 0x80:
+                if running_status is None:
+                    raise OSError('running status without last_status')
+                status = running_status
+            else:
+                offset += 1
+                # meta events do not set the running status
+                if status != 0xFF:
+                    running_status = status
+
+            if status == 0xFF:
+                kind = data[offset]
+                length, offset = read_variable_int(data, offset + 1)
+                if kind == 0x58:
+                    yield TimeSignatureEvent('time_signature', time, data[offset], 2 ** data[offset + 1])
+                    time = 0
+                elif kind == 0x03:
+                    yield TrackNameEvent('track_name', time, bytes(data[offset:offset + length]).decode('latin1'))
+                    time = 0
+                offset += length
+            elif status == 0xF0 or status == 0xF7:
+                length, offset = read_variable_int(data, offset)
+                offset += length
+            elif status < 0xF0:
+                command = status & 0xF0
+                if command == 0x90 or command == 0x80:
+                    if leading:
+                        return
+                    yield NoteEvent('note_on' if command == 0x90 else 'note_off', time, data[offset], data[offset + 1])
+                    time = 0
+                offset += CHANNEL_MESSAGE_LENGTHS[command]
+            else:
+                offset += SYSTEM_MESSAGE_LENGTHS.get(status, 0)
+
+# Reads the parts of a standard midi file that convert needs, a stand-in for
+# mido.MidiFile. The file is memory mapped and tracks are only decoded when
+# they are iterated. data can be given instead of a filename
+class SmfFile:
+
+    def __init__(self, filename=None, data=None):
+        if filename is not None:
+            with open(filename, 'rb') as midi:
+                data = mmap.mmap(midi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.data = memoryview(data)
+        self.tracks = []
+
+        if bytes(self.data[:4]) != b'MThd':
+            raise OSError('MThd not found. Probably not a MIDI file')
+
+        length = int.from_bytes(self.data[4:8], 'big')
+        self.type = int.from_bytes(self.data[8:10], 'big')
+        self.ticks_per_beat = int.from_bytes(self.data[12:14], 'big')
+
+        # walk the chunks, other chunks than tracks are skipped
+        offset = 8 + length
+        while offset + 8 <= len(self.data):
+            name = bytes(self.data[offset:offset + 4])
+            length = int.from_bytes(self.data[offset + 4:offset + 8], 'big')
+            if name == b'MTrk':
+                self.tracks.append(SmfTrack(self.data[offset + 8:offset + 8 + length]))
+            offset += 8 + length
+
+    def save(self, filename=None, file=None):
+        if file is None:
+            with open(filename, 'wb') as file:
+                file.write(self.data)
+        else:
+            file.write(self.data)
+
+# The tracks of a midi file to convert, in file order. selection is a list
+# of track numbers (the control track is 0) and track names, or None for
+# all tracks, the control track (number 0) can not be selected. Names are
+# looked up at the start of the tracks first, so SmfFile only decodes the
+# rest of a track that is not selected when a name is still missing
+def select_tracks(midifile, selection=None):
+    # ignore control track
+    if selection is None:
+        return midifile.tracks[1:]
+
+    if 0 in selection:
+        raise ValueError("track 0 is the control track, it has no notes to convert")
+
+    numbers = {track for track in selection if isinstance(track, int)}
+    names = {track for track in selection if not isinstance(track, int)}
+    found = set()
+    selected = set()
+    unnamed = []
+
+    for i, track in enumerate(midifile.tracks[1:], 1):
+        name = track.leading_name() if isinstance(track, SmfTrack) else track.name
+        if i in numbers:
+            found.add(i)
+        elif names and name in names:
+            found.add(name)
+        else:
+            if name is None:
+                unnamed.append(i)
+            continue
+        selected.add(i)
+
+    # names that come later in a track are only looked for when needed
+    if not names <= found:
+        for i in unnamed:
+            name = midifile.tracks[i].name
+            if name in names:
+                found.add(name)
+                selected.add(i)
+
+    missing = [track for track in selection if track not in found]
+    if missing:
+        raise ValueError("no such track: {}".format(", ".join(str(track) for track in missing)))
+
+    return [midifile.tracks[i] for i in sorted(selected)]
+
+# Parses a comma separated track selection from the command line, numbers
+# select a track by number, anything else by name
+def parse_track_selection(text):
+    return [int(track) if track.strip().isdigit() else track.strip() for track in text.split(",")]
+
+# The first time signature in the file, this is used for all tracks. It is
+# looked for in the control track and the tracks to convert first, the
+# other tracks are only decoded when none of those has one
+def first_time_signature(midifile, tracks=None):
+    searched = midifile.tracks[:1] + list(midifile.tracks[1:] if tracks is None else tracks)
+    ids = {id(track) for track in searched}
+    others = [track for track in midifile.tracks if id(track) not in ids]
+
+    for track in searched + others:
+        for msg in track:
+            if msg.type == 'time_signature':
+                return msg
+
+# Converts the notes of one track into a staff. Tracks only share the time
+# signature and the ticks per beat, so they can be converted in any order.
+# With jobs > 1 a long track is cut at silences and the parts are converted
+# in parallel, this needs the vectorized ingest
+def convert_track(track, time_signature, ticks_per_beat, quantize_duration=None, vectorized=False, jobs=1):
+    started = time.perf_counter()
     context = ParseContext()
+    context.track = track
+    context.staff = Staff(track.name)
+    context.quantization = context.staff.quantization
+    if isinstance(quantize_duration, Duration):
+        context.staff.quantize_duration = quantize_duration
 
-    print(midifile.ticks_per_beat)
-    
-    for i, track in enumerate(midifile.tracks):
-        
-        context.position = 0
-        context.midi_notes = []
-
-        # ignore control track
-        if (i > 0):
-
-            print(track)
-
-            # TODO: track handler function
-            context.track = track
-            context.staff = Staff(track.name)
-            
-            # first track gets added directly to file.
-            # a second track causes a staffgroup to be inserted
-            if file.empty():
-                file.add(context.staff)
-            else:
-                if staffGroup == None:
-                    staffGroup = StaffGroup()
-                    staffGroup.add(file.expressions())
-                    file.pop()
-                    file.add(staffGroup)
-                staffGroup.add(context.staff)
+    if time_signature is not None:
+        time_signature_handler(time_signature, context, ticks_per_beat, quantize_duration)
 
+    if vectorized:
+        convert_track_columns(track, context, ticks_per_beat, quantize_duration, jobs)
+    else:
         for msg in track:
-
-            #print(msg)
-            
             context.position += msg.time
-            
-            # for now, ignore changes in time signature mid song
-            if msg.type == 'time_signature' and context.time_signature == None:
-                context.time_signature = TimeSignature(msg.numerator, msg.denominator)
-                context.ticks_per_beat = midifile.ticks_per_beat
-                if quantize_duration:
-                    context.quantize_ticks = quantize_duration.get_ticks(midifile.ticks_per_beat, msg.denominator)
 
             if is_note_on_message(msg):
                 note_on_handler(msg, context)
-                
+
             if is_note_off_message(msg):
                 note_off_handler(msg, context)
 
+    if context.polyphonic_context:
+        context.polyphonic_context.close()
+
+    metrics.observe('track', time.perf_counter() - started)
+    return context.staff
+
+# Keeps the lilypond output of conversions in a directory, one file per
+# conversion, named after a hash of the midi bytes, the quantization, the
+# lilypond version and the version of midi2lily. When the files take more
+# than max_size bytes, the least recently used ones are removed
+class ConversionCache:
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        # the directory is only scanned again when it looks too big
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def key(self, midi_bytes, quantize_duration=None, tracks=None):
+        if isinstance(quantize_duration, Duration):
+            quantize_duration = quantize_duration.length()
+        options = "midi2lily {}\nlilypond {}\nquantize {}\ntracks {!r}\n".format(__version__, LILYPOND_VERSION, quantize_duration, tracks)
+        digest = hashlib.sha256(options.encode())
+        digest.update(midi_bytes)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".ly")
+
+    # returns the cached text, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as cached:
+                text = cached.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # the modification time marks when an entry was used last
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        # write to a temporary file first, so readers never see half a file
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        path = self.path(key)
+        try:
+            with os.fdopen(descriptor, 'w') as output:
+                output.write(text)
+            size = os.stat(temporary).st_size
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        self.size += size - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    # (modification time, size, path) of every entry
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".ly"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    # other processes can share the directory, so the size is counted again
+    def evict(self):
+        entries = self.entries()
+        self.size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= entry_size
+
+# vectorized selects the numpy ingest of the note messages (the default
+# when numpy is installed). quantize_duration can be AUTO_QUANTIZE to pick
+# a grid for every track, which needs numpy. With jobs > 1 the tracks are
+# converted in a pool of worker processes, a single track is split up at
+# silences. With a cache (a ConversionCache), the result can come from an
+# earlier conversion of the same midi data, it is a CachedFile then.
+# tracks selects the tracks to convert (see select_tracks)
+def convert(midifile, quantize_duration=None, vectorized=None, jobs=1, cache=None, tracks=None):
+
+    if cache is not None:
+        # a file read by SmfFile is hashed in place
+        if isinstance(midifile, SmfFile):
+            midi_bytes = midifile.data
+        else:
+            buffer = io.BytesIO()
+            midifile.save(file=buffer)
+            midi_bytes = buffer.getvalue()
+        key = cache.key(midi_bytes, quantize_duration, tracks)
+
+        text = cache.get(key)
+        if text is not None:
+            metrics.count('cache_hits')
+            return CachedFile(text)
+
+        result = convert(midifile, quantize_duration, vectorized, jobs, tracks=tracks)
+        cache.put(key, render(result))
+        return result
+
+    started = time.perf_counter()
+
+    if vectorized is None:
+        vectorized = numpy is not None
+
+    if quantize_duration == AUTO_QUANTIZE and not vectorized:
+        raise ValueError("automatic quantization needs numpy")
+
+    tracks = select_tracks(midifile, tracks)
+    time_signature = first_time_signature(midifile, tracks)
+    arguments = (time_signature, midifile.ticks_per_beat, quantize_duration, vectorized)
+
+    if jobs > 1 and len(tracks) == 1:
+        staves = [convert_track(tracks[0], *arguments, jobs=jobs)]
+    elif jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(tracks))) as executor:
+            futures = [executor.submit(collect_metrics, convert_track, track, *arguments) for track in tracks]
+            staves = []
+            for future in futures:
+                staff, track_metrics = future.result()
+                staves.append(staff)
+                metrics.merge(track_metrics)
+    else:
+        staves = [convert_track(track, *arguments) for track in tracks]
+
+    result = assemble_file(staves)
+    metrics.count('files')
+    metrics.observe('convert', time.perf_counter() - started)
+    return result
+
+# The lilypond text of a converted file, timed as the render stage
+def render(result):
+    started = time.perf_counter()
+    text = str(result)
+    metrics.observe('render', time.perf_counter() - started)
+    return text
+
+# Converts a midi file held in memory: bytes, a bytearray, a memoryview or
+# an mmap. SmfFile reads the events straight from the buffer, which is
+# not copied, so an upload can be converted without a temporary file
+def convert_bytes(buffer, quantize_duration=None, vectorized=None, jobs=1, cache=None, tracks=None):
+    return convert(SmfFile(data=buffer), quantize_duration, vectorized, jobs, cache, tracks)
+
+# Converts a midi file given as a path, a buffer (see convert_bytes) or a
+# midi file object
+def convert_input(source, quantize_duration=None, cache=None, tracks=None):
+    if isinstance(source, (str, os.PathLike)):
+        source = SmfFile(source)
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        source = SmfFile(data=source)
+    return convert(source, quantize_duration, cache=cache, tracks=tracks)
+
+# Cumulative counts of a convert_many run. Notes are only counted for the
+# files that were converted, not for the ones that came from the cache
+class BatchStats:
+
+    def __init__(self):
+        self.files = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.staves = 0
+        self.notes = 0
+        self.seconds = 0.0
+
+    # file_metrics are the metrics recorded while converting result
+    def add(self, result, file_metrics):
+        self.files += 1
+        self.notes += file_metrics.counters['notes']
+        if isinstance(result, CachedFile):
+            self.cache_hits += 1
+        else:
+            self.staves += sum(1 for staff in result.staves())
+
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0
+
+    def __str__(self):
+        return "converted {} of {} files in {:.2f}s ({:.1f} files/sec), {} staves, {} notes, {} from the cache".format(
+            self.files - self.failures, self.files, self.seconds, self.files_per_second(), self.staves, self.notes, self.cache_hits)
+
+# Converts many midi files (see convert_input for what an input can be)
+# and yields the results lazily, in input order. Pitches, durations and
+# their formatted strings are pooled for the whole process, so they stay
+# warm from one file to the next; with jobs > 1 the files go to a pool of
+# worker processes that live for the whole run, with at most two files per
+# worker in flight. A failing file raises, or is yielded as its exception
+# with return_exceptions. stats (a BatchStats) is updated with every file
+def convert_many(inputs, quantize_duration=None, jobs=1, cache=None, tracks=None, stats=None, return_exceptions=False):
+    if stats is None:
+        stats = BatchStats()
+    started = time.perf_counter() - stats.seconds
+
+    def finish(result):
+        try:
+            result, file_metrics = result()
+            metrics.merge(file_metrics)
+            stats.add(result, file_metrics)
+        except Exception as exception:
+            stats.files += 1
+            stats.failures += 1
+            metrics.count('failures')
+            if not return_exceptions:
+                raise
+            result = exception
+        finally:
+            stats.seconds = time.perf_counter() - started
+        return result
+
+    if jobs <= 1:
+        for source in inputs:
+            yield finish(lambda: collect_metrics(convert_input, source, quantize_duration, cache, tracks))
+        return
+
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    try:
+        pending = collections.deque()
+        for source in inputs:
+            # views can not be sent to another process
+            if isinstance(source, (memoryview, mmap.mmap)):
+                source = bytes(source)
+            pending.append(executor.submit(collect_metrics, convert_input, source, quantize_duration, cache, tracks))
+            if len(pending) > 2 * jobs:
+                yield finish(pending.popleft().result)
+        while pending:
+            yield finish(pending.popleft().result)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+# The result of a future of collect_metrics, after merging its metrics
+def merge_metrics(future):
+    result, worker_metrics = future.result()
+    metrics.merge(worker_metrics)
+    return result
+
+def assemble_file(staves):
+    file = File()
+
+    # a single track gets added directly to file,
+    # more tracks are grouped in a staffgroup
+    if len(staves) == 1:
+        file.add(staves[0])
+    elif staves:
+        staffGroup = StaffGroup()
+        staffGroup.add(staves)
+        file.add(staffGroup)
+
     return file
+
+# Hash of all messages of a track, including their delta times
+def track_fingerprint(track):
+    if isinstance(track, SmfTrack):
+        return hashlib.sha256(track.data).hexdigest()
+
+    digest = hashlib.sha256()
+    for msg in track:
+        digest.update(msg.time.to_bytes(4, 'little'))
+        digest.update(bytes(msg.bytes()))
+    return digest.hexdigest()
+
+# Converts new versions of the same midi file, e.g. while it is being
+# edited. A track that did not change since the previous version is not
+# converted again: its staff, which is frozen to keep the rendered text,
+# is reused
+class IncrementalConverter:
+
+    def __init__(self, quantize_duration=None, vectorized=None):
+        self.quantize_duration = quantize_duration
+        self.vectorized = numpy is not None if vectorized is None else vectorized
+        self.staves = {}
+        self.converted = 0
+        self.reused = 0
+
+    def convert(self, midifile):
+        time_signature = first_time_signature(midifile)
+        header = ((time_signature.numerator, time_signature.denominator) if time_signature else None, midifile.ticks_per_beat)
+
+        # only the staves of the latest version are kept
+        staves = {}
+        result = []
+        for track in midifile.tracks[1:]:
+            key = (track_fingerprint(track), header)
+            staff = staves.get(key, self.staves.get(key))
+
+            if staff is None:
+                staff = convert_track(track, time_signature, midifile.ticks_per_beat, self.quantize_duration, self.vectorized)
+                staff.freeze()
+                self.converted += 1
+            else:
+                self.reused += 1
+
+            staves[key] = staff
+            result.append(staff)
+
+        self.staves = staves
+        return assemble_file(result)
+
+# Converts the messages of a track as they come in and produces the
+# lilypond text of the staff in parts. A part is written as soon as it is
+# closed: it is at least a measure long, no note sounds across its end,
+# and the staff does not end in a polyphonic context. It is then thrown
+# away, so memory does not grow with the length of the track. The text is
+# the same as for a Staff, except that the clef is chosen for every part
+# instead of for the whole staff, and that note-offs without a note-on are
+# left out
+class StaffStream:
+
+    def __init__(self, track, time_signature, ticks_per_beat, quantize_ticks=None, render_context=None):
+        self.name = track.name
+        self.context = ParseContext()
+        self.context.track = track
+        self.context.time_signature = time_signature
+        self.context.ticks_per_beat = ticks_per_beat
+        self.context.quantize_ticks = quantize_ticks
+        self.context.staff = Staff(self.name)
+        self.render_context = render_context if render_context is not None else RenderContext()
+        self.measure_ticks = time_signature.get_measure_span().get_ticks(ticks_per_beat, time_signature.denominator)
+
+        # where the part that has not been written starts, and where the
+        # notes in it end, in ticks
+        self.base = 0
+        self.end = 0
+        self.clef = None
+        self.parts = 0
+
+    def opening(self):
+        yield from self.context.staff.opening_chunks(self.render_context)
+
+    # handles a message and yields the text of the parts it closes
+    def message(self, msg):
+        context = self.context
+        context.position += msg.time
+
+        if is_note_on_message(msg):
+            note_on_handler(msg, context)
+
+        if is_note_off_message(msg):
+            # a note without a note-on would start in a part that is gone
+            if msg.note not in context.active_pitches:
+                warn_unpaired_note_off(msg.note, msg.time, context.position, context)
+            else:
+                midi_note = convert_to_midi_note(msg, context)
+                self.end = max(self.end, midi_note.end)
+                handle_midi_note(MidiNote(midi_note.start - self.base, midi_note.end - self.base, midi_note.pitch), context)
+
+        if self.is_closed():
+            yield from self.write_part()
+
+    # moves the position on without a message, while a live player pauses,
+    # and yields the text of the parts that closes. Silence up to the last
+    # measure line that notes arriving later can not quantize back over is
+    # written as a rest, so finished measures do not wait for the next note
+    def advance(self, time):
+        context = self.context
+        context.position += time
+        if context.active_pitches or context.polyphonic_context is not None or isinstance(context.staff.last(), PolyphonicContext):
+            return
+
+        line = (context.position - (context.quantize_ticks or 0)) // self.measure_ticks * self.measure_ticks
+        if line > self.end:
+            context.staff.add(Rest(Duration.get_duration(line - self.end, context.ticks_per_beat, context.time_signature.denominator)))
+            self.end = line
+
+        if self.is_closed():
+            yield from self.write_part()
+
+    def is_closed(self):
+        context = self.context
+        if context.active_pitches or context.polyphonic_context is not None or isinstance(context.staff.last(), PolyphonicContext):
+            return False
+
+        # notes that start later can not start before this
+        position = quantize(context.position, context.quantize_ticks) if context.quantize_ticks else context.position
+        return self.end <= position and self.end - self.base >= self.measure_ticks
+
+    def write_part(self):
+        staff = self.context.staff
+
+        clef = staff.get_clef() or 'treble'
+        if clef != (self.clef or 'treble'):
+            yield "\\clef {}\n".format(clef)
+        self.clef = clef
+
+        yield from staff.children_chunks(self.render_context)
+
+        self.base = self.end
+        self.context.staff = Staff(self.name)
+        self.parts += 1
+
+    # yields the rest of the staff at the end of the track
+    def close(self):
+        context = self.context
+        if context.polyphonic_context:
+            context.polyphonic_context.close()
+            context.polyphonic_context = None
+
+        if context.staff.last() is not None:
+            yield from self.write_part()
+        yield "}"
+
+# A staff that converts its track while it is rendered (see StaffStream)
+class StreamedStaff(Expression):
+
+    def __init__(self, track, time_signature, ticks_per_beat, quantize_ticks=None):
+        self.track = track
+        self.time_signature = time_signature
+        self.ticks_per_beat = ticks_per_beat
+        self.quantize_ticks = quantize_ticks
+
+    def chunks(self, context = None):
+        stream = StaffStream(self.track, self.time_signature, self.ticks_per_beat, self.quantize_ticks, context)
+        yield from stream.opening()
+        for msg in self.track:
+            yield from stream.message(msg)
+        yield from stream.close()
+
+# Converts a midi file and writes it to writer in bounded memory, see
+# StaffStream for how the output differs from convert. The tracks are
+# written one after the other, automatic quantization is not possible
+def convert_streaming(midifile, writer, quantize_duration=None, tracks=None):
+    if quantize_duration == AUTO_QUANTIZE:
+        raise ValueError("automatic quantization needs the whole track")
+
+    tracks = select_tracks(midifile, tracks)
+    time_signature = first_time_signature(midifile, tracks)
+    context = ParseContext()
+    time_signature_handler(time_signature, context, midifile.ticks_per_beat, quantize_duration)
+
+    started = time.perf_counter()
+    staves = [StreamedStaff(track, context.time_signature, midifile.ticks_per_beat, context.quantize_ticks) for track in tracks]
+    assemble_file(staves).render(writer)
+    # conversion and rendering are one stage here
+    metrics.count('files')
+    metrics.observe('stream', time.perf_counter() - started)
     
-if __name__ == '__main__':
-    
+# Parses raw midi bytes as they arrive, e.g. from a keyboard. The running
+# status and an unfinished message are kept between calls to feed
+class MidiByteParser:
+
+    def __init__(self):
+        self.status = None
+        self.data = []
+        self.in_sysex = False
+
+    # yields (status, data bytes) for every channel message completed by data
+    def feed(self, data):
+        for byte in data:
+            # real time messages can appear anywhere, even inside messages
+            if byte >= 0xF8:
+                continue
+
+            if byte >= 0x80:
+                self.data = []
+                self.in_sysex = byte == 0xF0
+                # system messages cancel the running status, their data is skipped
+                self.status = byte if byte < 0xF0 else None
+                continue
+
+            if self.in_sysex or self.status is None:
+                continue
+
+            self.data.append(byte)
+            if len(self.data) == CHANNEL_MESSAGE_LENGTHS[self.status & 0xF0]:
+                yield self.status, self.data
+                self.data = []
+
+# Notates live midi input. Raw midi bytes are fed in as they arrive, their
+# arrival time is turned into ticks with the tempo, and the notes go
+# through a StaffStream, which writes every part of the staff to writer as
+# soon as it is closed. The time it takes to handle each message is kept,
+# to check that conversion keeps up with the player
+class LiveConverter:
+
+    def __init__(self, writer, name="live", tempo=120, ticks_per_beat=480, time_signature=None, quantize_duration=None, latency_target=0.01, clock=time.perf_counter, start=None):
+        self.writer = writer
+        self.tempo = tempo
+        self.ticks_per_beat = ticks_per_beat
+        self.latency_target = latency_target
+        self.clock = clock
+        self.parser = MidiByteParser()
+        # the time of tick 0, the first message if not given
+        self.start = start
+        self.position = 0
+
+        # the latencies of the latest messages, in seconds
+        self.latencies = collections.deque(maxlen=10000)
+        self.late = 0
+
+        time_signature = time_signature or TimeSignature(4, 4)
+        quantize_ticks = quantize_duration.get_ticks(ticks_per_beat, time_signature.denominator) if quantize_duration else None
+        track = mido.MidiTrack()
+        track.name = name
+        self.stream = StaffStream(track, time_signature, ticks_per_beat, quantize_ticks)
+
+        self.write(["\\version \"{}\"\n\n".format(LILYPOND_VERSION)])
+        self.write(self.stream.opening())
+
+    def write(self, chunks):
+        text = "".join(chunks)
+        if text:
+            self.writer.write(text)
+            if hasattr(self.writer, 'flush'):
+                self.writer.flush()
+
+    def ticks(self, timestamp):
+        if self.start is None:
+            self.start = timestamp
+        return round((timestamp - self.start) * self.tempo / 60 * self.ticks_per_beat)
+
+    # handles the bytes that arrived at timestamp (seconds, default now)
+    def feed(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+
+        for status, (note, velocity) in ((status, data) for status, data in self.parser.feed(data) if status & 0xE0 == 0x80):
+            started = self.clock()
+
+            tick = max(self.position, self.ticks(timestamp))
+            msg = NoteEvent('note_on' if status & 0xF0 == 0x90 else 'note_off', tick - self.position, note, velocity)
+            # bytes that arrive together would give notes without length
+            if is_note_off_message(msg) and self.stream.context.active_pitches.get(note) == tick:
+                tick += 1
+                msg = msg._replace(time=msg.time + 1)
+            self.position = tick
+            self.write(self.stream.message(msg))
+
+            latency = self.clock() - started
+            self.latencies.append(latency)
+            if latency > self.latency_target:
+                self.late += 1
+
+    # writes the measures that ended by now (seconds, default now) while
+    # no message arrives
+    def tick(self, now=None):
+        if self.start is None:
+            return
+        tick = self.ticks(self.clock() if now is None else now)
+        if tick > self.position:
+            self.write(self.stream.advance(tick - self.position))
+            self.position = tick
+
+    # reads a binary file (stdin, a fifo) or a connected socket until it
+    # ends. When nothing arrives for interval seconds, the clock ticks
+    def run(self, source, interval=0.05):
+        while True:
+            if not select.select([source], [], [], interval)[0]:
+                self.tick()
+                continue
+            data = source.recv(4096) if hasattr(source, 'recv') else os.read(source.fileno(), 4096)
+            if not data:
+                break
+            self.feed(data)
+
+    def close(self):
+        self.write(self.stream.close())
+
+    # latency of the messages below which the given percentages fall
+    def latency_percentiles(self, percentages=(50, 90, 99)):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return {p: latencies[min(len(latencies) - 1, math.ceil(p / 100 * len(latencies)) - 1)] for p in percentages}
+
+# Converts one midi file. The result is written to a .ly file in
+# output_directory, or returned when there is no output directory. Also
+# returns a report of the quantization of every track when stats is set,
+# and whether the result came from the cache. Runs in the worker processes
+# of main, or converts its tracks in jobs processes when there is only one
+# file. The cache is keyed on the bytes of the file as they are on disk.
+# With stream, the file is converted with convert_streaming straight into
+# the output file or stdout, without cache or stats
+def convert_file(path, quantize_duration=None, output_directory=None, stats=False, jobs=1, cache=None, tracks=None, stream=False, writer=None):
+    midifile = SmfFile(path)
+
+    if stream:
+        if output_directory:
+            with open(os.path.join(output_directory, output_name(path)), 'w') as output:
+                convert_streaming(midifile, output, quantize_duration, tracks)
+                output.write("\n")
+        else:
+            convert_streaming(midifile, sys.stdout, quantize_duration, tracks)
+            sys.stdout.write("\n")
+        return None, "", False
+
+    key = None
+    text = None
+    result = None
+
+    if cache is not None:
+        key = cache.key(midifile.data, quantize_duration, tracks)
+        text = cache.get(key)
+
+    hit = text is not None
+
+    if hit:
+        metrics.count('cache_hits')
+    else:
+        result = convert(midifile, quantize_duration, jobs=jobs, tracks=tracks)
+        if cache is not None:
+            text = render(result)
+            cache.put(key, text)
+
+    if output_directory:
+        with open(os.path.join(output_directory, output_name(path)), 'w') as output:
+            write_result(result, text, output)
+        text = None
+    elif writer is not None:
+        write_result(result, text, writer)
+        text = None
+    else:
+        text = (text if text is not None else render(result)) + "\n"
+
+    report = []
+    if stats and result is not None:
+        for staff in result.staves():
+            grid = staff.quantize_duration.length() if staff.quantize_duration else "no quantization"
+            report.append("{}: {}: {}: {}\n".format(path, staff.name(), grid, staff.quantization))
+
+    return text, "".join(report), hit
+
+# The name of the .ly file written for an input file in an output directory
+def output_name(path):
+    return os.path.splitext(os.path.basename(path))[0] + ".ly"
+
+# Writes a converted file and a newline. A file that is not rendered yet
+# (text is None) is rendered straight into output, one chunk at a time
+def write_result(result, text, output):
+    if text is None:
+        started = time.perf_counter()
+        result.render(output)
+        metrics.observe('render', time.perf_counter() - started)
+    else:
+        output.write(text)
+    output.write("\n")
+
+# Writes the metrics of this process to a file, as json when its name
+# ends in .json and in the prometheus text format otherwise
+def write_metrics(filename):
+    with open(filename, 'w') as output:
+        output.write(metrics.to_json() if filename.endswith('.json') else metrics.to_prometheus())
+
+# Quantization from a denominator (16 for a 16th note), 'auto' or None
+def parse_quantize(denominator):
+    if denominator is None or denominator == '':
+        return None
+    if denominator == AUTO_QUANTIZE:
+        return AUTO_QUANTIZE
+    return Duration(Fraction(1, int(denominator)))
+
+# Runs in the worker processes of a ConversionServer
+def convert_request(midi_bytes, quantize_denominator=None, tracks=None):
+    return render(convert_bytes(midi_bytes, parse_quantize(quantize_denominator), tracks=tracks))
+
+# Makes a worker process import and fill its caches before the first
+# request arrives
+def warm_worker():
+    midifile = mido.MidiFile()
+    midifile.tracks.append(mido.MidiTrack([mido.MetaMessage('time_signature')]))
+    track = mido.MidiTrack()
+    track.extend([mido.Message('note_on', note=60, time=0), mido.Message('note_off', note=60, time=midifile.ticks_per_beat)])
+    midifile.tracks.append(track)
+
+    buffer = io.BytesIO()
+    midifile.save(file=buffer)
+    return convert_request(buffer.getvalue())
+
+# Converts midi files sent over a local socket, one json object per line:
+#
+#   {"id": 1, "midi": "<base64 midi file>", "quantize": "16", "tracks": [1]}
+#
+# quantize and tracks are optional. Every request gets a line back, in
+# request order on each connection, with either "lilypond" or "error" and
+# the id of the request. {"id": 2, "metrics": "prometheus"} (or "json")
+# gets the metrics of the server as "metrics", including the requests
+# before it on the same connection. The files are converted in a pool of worker
+# processes that are started and warmed up before the server accepts
+# connections. At most queue_size requests wait for a worker, and at most
+# queue_size responses wait to be written on each connection; when either
+# is full, connections are not read from until there is room again, so clients that send too much are slowed down instead of using up memory.
+# Requests longer than max_request_size get an error and end the connection.
+# A request that takes longer than timeout seconds gets an error. The
+# worker finishes it anyway and takes no other request until then, the
+# result is thrown away
+class ConversionServer:
+
+    def __init__(self, jobs=1, queue_size=64, timeout=30, max_request_size=64 * 1024 * 1024):
+        self.jobs = jobs
+        self.max_request_size = max_request_size
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.jobs)
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_worker) for i in range(self.jobs)])
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.workers = [asyncio.create_task(self.work()) for i in range(self.jobs)]
+
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path, limit=self.max_request_size)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=self.max_request_size)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.executor.shutdown(cancel_futures=True)
+
+    # the address clients connect to
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            arguments, result = await self.queue.get()
+            conversion = loop.run_in_executor(self.executor, collect_metrics, convert_request, *arguments)
+            try:
+                text, worker_metrics = await asyncio.wait_for(asyncio.shield(conversion), self.timeout)
+                metrics.merge(worker_metrics)
+                result.set_result({"lilypond": text})
+            except asyncio.TimeoutError:
+                result.set_result({"error": "timed out after {}s".format(self.timeout)})
+                # the worker process is busy until the conversion ends, the
+                # next request waits here instead of in the executor
+                try:
+                    metrics.merge((await conversion)[1])
+                except Exception:
+                    pass
+            except Exception as exception:
+                result.set_result({"error": repr(exception)})
+            finally:
+                self.queue.task_done()
+
+    async def handle_connection(self, reader, writer):
+        # a client that does not read its responses is not read from either
+        responses = asyncio.Queue(self.queue_size)
+        sender = asyncio.create_task(self.send(responses, writer))
+        previous = None
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # the rest of the line can not be skipped, so the connection ends
+                    metrics.count('requests')
+                    result = asyncio.get_running_loop().create_future()
+                    result.set_result({"error": "request longer than {} bytes".format(self.max_request_size)})
+                    await responses.put((None, result, time.perf_counter()))
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                metrics.count('requests')
+                started = time.perf_counter()
+                result = asyncio.get_running_loop().create_future()
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    if "metrics" in request:
+                        result = asyncio.ensure_future(self.report_metrics(request["metrics"], previous))
+                        await responses.put((request_id, result, started))
+                        continue
+                    tracks = request.get("tracks")
+                    arguments = (base64.b64decode(request["midi"]), request.get("quantize"), tracks)
+                except Exception as exception:
+                    result.set_result({"error": "bad request: {!r}".format(exception)})
+                else:
+                    # waits for room in the queue
+                    await self.queue.put((arguments, result))
+
+                await responses.put((request_id, result, started))
+                previous = result
+        finally:
+            await responses.put(None)
+            await sender
+
+    # the metrics after the request before it on the connection is done
+    async def report_metrics(self, format, previous):
+        if previous is not None:
+            await previous
+        return {"metrics": metrics.to_json() if format == "json" else metrics.to_prometheus()}
+
+    async def send(self, responses, writer):
+        connected = True
+        try:
+            while True:
+                response = await responses.get()
+                if response is None:
+                    break
+
+                request_id, result, started = response
+                message = dict(await result, id=request_id)
+                metrics.observe('request', time.perf_counter() - started)
+                if "error" in message:
+                    metrics.count('failures')
+
+                # when the client is gone, the responses are still taken
+                # from the queue, so the connection handler is not blocked
+                if connected:
+                    try:
+                        writer.write(json.dumps(message).encode() + b"\n")
+                        await writer.drain()
+                    except ConnectionError:
+                        connected = False
+        finally:
+            writer.close()
+
+# Runs a ConversionServer until interrupted. address is host:port or the
+# path of a unix socket
+def serve(address, jobs=1, queue_size=64, timeout=30):
+    async def run():
+        server = ConversionServer(jobs, queue_size, timeout)
+        host, separator, port = address.rpartition(':')
+        if separator and port.isdigit():
+            await server.start(host or '127.0.0.1', int(port))
+        else:
+            await server.start(path=address)
+        sys.stderr.write("serving on {} with {} workers\n".format(server.address(), jobs))
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+def main(argv=None):
+
     # Setup command line options
     parser = argparse.ArgumentParser(description='Converts a midi file to lilypond file')
-    parser.add_argument('files', metavar='input', type=str, nargs='+',
+    parser.add_argument('files', metavar='input', type=str, nargs='*',
                        help='midi files to be converted')
     parser.add_argument('-q', '--quantize', dest='quantize_denominator', default=None,
-                       help='quantization value (16 for quantizing to a 16th note)')
-    
-    args = parser.parse_args()
-    
-    if args.quantize_denominator:
-        quantize_duration = Duration(Fraction(1, int(args.quantize_denominator)))
-        [print(convert(mido.MidiFile(file), quantize_duration)) for file in args.files]
-    else:
-        [print(convert(mido.MidiFile(file))) for file in args.files]
\ No newline at end of file
+                       help='quantization value (16 for quantizing to a 16th note, auto to pick one for every track)')
+    parser.add_argument('--stats', action='store_true',
+                       help='report the quantization error of every track on stderr')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                       help='number of files to convert in parallel (0 for one per cpu)')
+    parser.add_argument('-o', '--output-directory', default=None,
+                       help='write a .ly file for every input file to this directory instead of to stdout')
+    parser.add_argument('-t', '--tracks', type=parse_track_selection, default=None,
+                       help='comma separated track numbers (the first track after the control track is 1) or names to convert')
+    parser.add_argument('--stream', action='store_true',
+                       help='write measures as soon as they are converted, in memory that does not grow with the length of the file')
+    parser.add_argument('--live', action='store_true',
+                       help='notate raw midi bytes from the input (- for stdin, or a fifo) as they arrive')
+    parser.add_argument('--tempo', type=int, default=120,
+                       help='tempo of live input in beats per minute (default 120)')
+    parser.add_argument('--serve', metavar='ADDRESS', default=None,
+                       help='convert midi files sent as json lines to ADDRESS (host:port or a unix socket path) instead of input files')
+    parser.add_argument('--timeout', type=float, default=30,
+                       help='seconds a request to the server may take (default 30)')
+    parser.add_argument('--queue-size', type=int, default=64,
+                       help='number of requests that can wait for a server worker (default 64)')
+    parser.add_argument('--metrics', metavar='FILE', default=None,
+                       help='write conversion metrics to FILE when done, as json for a .json file and else in the prometheus text format')
+    parser.add_argument('--cache', dest='cache_directory', default=None,
+                       help='keep converted files in this directory and reuse them for the same midi data')
+    parser.add_argument('--cache-size', type=int, default=256,
+                       help='size limit of the cache in MB (default 256)')
+
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.jobs or os.cpu_count(), args.queue_size, args.timeout)
+        return 0
+
+    if not args.files:
+        parser.error("the following arguments are required: input")
+
+    quantize_duration = parse_quantize(args.quantize_denominator)
+
+    if args.live:
+        converter = LiveConverter(sys.stdout, tempo=args.tempo, quantize_duration=quantize_duration if isinstance(quantize_duration, Duration) else None)
+        if args.files[0] == '-':
+            converter.run(sys.stdin.buffer)
+        else:
+            with open(args.files[0], 'rb', buffering=0) as source:
+                converter.run(source)
+        converter.close()
+        if args.metrics:
+            write_metrics(args.metrics)
+
+        percentiles = converter.latency_percentiles()
+        sys.stderr.write("{} messages, latency {}, {} over {:.0f}ms\n".format(len(converter.latencies),
+            ", ".join("p{} {:.3f}ms".format(p, latency * 1000) for p, latency in percentiles.items()), converter.late, converter.latency_target * 1000))
+        return 0
+
+    if args.output_directory:
+        os.makedirs(args.output_directory, exist_ok=True)
+
+    cache = None
+    if args.cache_directory:
+        cache = ConversionCache(args.cache_directory, args.cache_size * 1024 * 1024)
+
+    jobs = args.jobs or os.cpu_count()
+    # a single file is split up by track instead
+    track_jobs = jobs if len(args.files) == 1 else 1
+    # streams to stdout can not come from worker processes
+    parallel = jobs > 1 and len(args.files) > 1 and not (args.stream and not args.output_directory)
+    executor = concurrent.futures.ProcessPoolExecutor(jobs) if parallel else None
+    started = time.perf_counter()
+    failures = []
+    hits = 0
+
+    # inputs that would write the same .ly file (x.mid and x.midi, a/x.mid
+    # and b/x.mid, a file given twice) are not converted, as which one is
+    # left would be down to chance
+    files = args.files
+    if args.output_directory:
+        inputs = collections.defaultdict(list)
+        for i, file in enumerate(args.files):
+            inputs[os.path.normcase(output_name(file))].append(i)
+        files = []
+        for i, file in enumerate(args.files):
+            shared = inputs[os.path.normcase(output_name(file))]
+            if len(shared) > 1:
+                failures.append(file)
+                sys.stderr.write("{}: failed: {} would also be written for {}\n".format(file, output_name(file), ", ".join(args.files[j] for j in shared if j != i)))
+            else:
+                files.append(file)
+
+    def results():
+        # results come back in input order, a failing file raises here.
+        # Without workers the files are rendered straight to stdout
+        if executor is None:
+            for file in files:
+                yield file, lambda file=file: convert_file(file, quantize_duration, args.output_directory, args.stats, track_jobs, cache, args.tracks, args.stream, sys.stdout)
+        else:
+            # at most two files per worker are in flight, so finished texts
+            # do not pile up while an earlier file is still converting
+            pending = collections.deque()
+            for file in files:
+                pending.append((file, executor.submit(collect_metrics, convert_file, file, quantize_duration, args.output_directory, args.stats, 1, cache, args.tracks, args.stream)))
+                if len(pending) > 2 * jobs:
+                    file, future = pending.popleft()
+                    yield file, functools.partial(merge_metrics, future)
+            while pending:
+                file, future = pending.popleft()
+                yield file, functools.partial(merge_metrics, future)
+
+    try:
+        for file, result in results():
+            try:
+                text, report, hit = result()
+            except Exception as exception:
+                failures.append(file)
+                metrics.count('failures')
+                sys.stderr.write("{}: failed: {!r}\n".format(file, exception))
+                continue
+
+            hits += hit
+            if text is not None:
+                sys.stdout.write(text)
+            sys.stderr.write(report)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - started
+    if len(args.files) > 1 or failures:
+        converted = len(args.files) - len(failures)
+        summary = "converted {} of {} files in {:.2f}s ({:.1f} files/sec)".format(
+            converted, len(args.files), elapsed, len(args.files) / elapsed if elapsed else 0)
+        if cache is not None:
+            summary += ", {} from the cache".format(hits)
+        sys.stderr.write(summary + "\n")
+
+    if args.metrics:
+        write_metrics(args.metrics)
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,26 @@
 import midi2lily
 import unittest
 import io
+import asyncio
+import json
+import base64
+import mmap
+import socket
+import gc
+import tracemalloc
+import tempfile
+import os
+import copy
+import pickle
+import re
+import warnings
 from fractions import Fraction
+from unittest import mock
 
-from mido import MidiFile
+from mido import MidiFile, MidiTrack, Message, MetaMessage
+import glob
+import shutil
+import concurrent.futures
 
 class LearningTests(unittest.TestCase):
 
@@ -51,6 +68,31 @@ class LilypondFileTest(unittest.TestCase):
         self.assertEqual(str(file),
                          "\\version \"1\"\n\n\\new Staff = \"trumpet\" \\relative c' {\ng'4 g g4. f8 |\ne8. d16 c8. e16 d4 g, |\n}")
 
+    def test_render_to_writer(self):
+        file = midi2lily.File("1")
+        staff = midi2lily.Staff("trumpet")
+        for _ in range(8):
+            staff.add(midi2lily.Note(midi2lily.Pitch(79), midi2lily.Duration.get_duration(1, 1, 4)))
+        file.add(staff)
+
+        writer = io.StringIO()
+        file.render(writer)
+
+        self.assertEqual(writer.getvalue(), str(file))
+        self.assertEqual(writer.getvalue(), "\\version \"1\"\n\n\\new Staff = \"trumpet\" \\relative c' {\ng'4 g g g |\ng g g g |\n}")
+
+    def test_chunks_are_streamed(self):
+        file = midi2lily.File("1")
+        staff = midi2lily.Staff("trumpet")
+        for _ in range(100):
+            staff.add(midi2lily.Note(midi2lily.Pitch(79), midi2lily.Duration.get_duration(1, 1, 4)))
+        file.add(staff)
+
+        chunks = list(file.chunks())
+
+        self.assertEqual("".join(chunks), str(file))
+        self.assertLess(max(len(chunk) for chunk in chunks), 30)
+
 class LilypondCompoundExpressionTest(unittest.TestCase):
 
     def test_empty_expression(self):
@@ -121,6 +163,26 @@ class LilypondCompoundExpressionSplitTest(unittest.TestCase):
         self.assertEqual(str(expression), "{\ng''4 g''4 g''4 g''4 }")
         self.assertEqual(str(new_expression), "{\ng''2 g''2 }")
 
+    def test_split_across_chunks(self):
+        expression = midi2lily.CompoundExpression()
+        expression._children.chunk_size = 4
+        for i in range(10):
+            expression.add(midi2lily.Note(midi2lily.Pitch(60 + i), midi2lily.Duration.get_duration(1, 1, 4)))
+
+        new_expression = expression.split_at(Fraction(5, 4))
+
+        self.assertEqual(len(expression._children), 5)
+        self.assertEqual(len(new_expression._children), 5)
+        self.assertEqual(expression.length(), Fraction(5, 4))
+        self.assertEqual(new_expression.length(), Fraction(5, 4))
+        self.assertEqual(str(new_expression), "{\nf'4 fis'4 g'4 gis'4 a'4 }")
+
+        expression.merge(new_expression)
+
+        self.assertEqual(len(expression._children), 10)
+        self.assertEqual(expression.length(), Fraction(10, 4))
+        self.assertEqual(expression.last(), midi2lily.Note(midi2lily.Pitch(69), midi2lily.Duration.get_duration(1, 1, 4)))
+
 
 class LilypondPolyphonicContextTest(unittest.TestCase):
 
@@ -265,6 +327,45 @@ class LilypondGetPitchesTest(unittest.TestCase):
         self.assertEqual(expression.highest_pitch(), 60)
         self.assertEqual(expression.get_clef(), 'bass')
 
+    def test_pitches_follow_mutations(self):
+        expression = midi2lily.CompoundExpression()
+        expression.add(midi2lily.Note(midi2lily.Pitch(54), midi2lily.Duration.get_duration(1, 1, 4)))
+        expression.add(midi2lily.Chord([midi2lily.Pitch(60), midi2lily.Pitch(64)], midi2lily.Duration.get_duration(1, 1, 4)))
+        expression.add(midi2lily.Note(midi2lily.Pitch(60), midi2lily.Duration.get_duration(1, 1, 4)))
+
+        self.assertEqual(expression.pitches(), {54, 60, 64})
+
+        # pitch 60 is still used by the chord
+        expression.pop()
+        self.assertEqual(expression.pitches(), {54, 60, 64})
+
+        new_expression = expression.split_at(Fraction(1, 4))
+        self.assertEqual(expression.pitches(), {54})
+        self.assertEqual(new_expression.pitches(), {60, 64})
+        self.assertEqual(new_expression.pitch_summary().average(), 62)
+
+        new_expression.merge(expression)
+        self.assertEqual(new_expression.pitches(), {54, 60, 64})
+        self.assertEqual(new_expression.get_clef(), 'bass')
+
+    def test_nested_pitches(self):
+        inner = midi2lily.CompoundExpression()
+        outer = midi2lily.CompoundExpression()
+        outer.add(inner)
+
+        # pitches added to a nested expression count for the outer one,
+        # pitches in polyphonic voices do not
+        inner.add(midi2lily.Note(midi2lily.Pitch(50), midi2lily.Duration.get_duration(1, 1, 4)))
+        voice = midi2lily.CompoundExpression()
+        polyphonic_context = midi2lily.PolyphonicContext()
+        polyphonic_context.add(voice)
+        outer.add(polyphonic_context)
+        voice.add(midi2lily.Note(midi2lily.Pitch(40), midi2lily.Duration.get_duration(1, 1, 4)))
+
+        self.assertEqual(outer.pitches(), {50})
+        self.assertEqual(outer.lowest_pitch(), 50)
+        self.assertEqual(outer.highest_pitch(), 50)
+
 class LilypondStaffTest(unittest.TestCase):
 
     def test_empty_staff(self):
@@ -338,6 +439,25 @@ class LilypondDurationTest(unittest.TestCase):
         # half + 1/8 note
         self.assertEqual(str(midi2lily.Duration.get_duration(5, 2, 4)), "2~ 8")
 
+    def test_exact_decomposition(self):
+        # runs of dots are written as one dotted note
+        self.assertEqual(str(midi2lily.Duration(Fraction(11, 16))), "2~ 8.")
+        self.assertEqual(str(midi2lily.Duration(Fraction(13, 16))), "2.~ 16")
+        self.assertEqual(str(midi2lily.Duration(Fraction(11, 4))), "1~ 1..")
+
+        # tuplet durations keep their tuplet denominator
+        self.assertEqual(str(midi2lily.Duration(Fraction(1, 3))), "3")
+        self.assertEqual(str(midi2lily.Duration(Fraction(2, 3))), "3~ 3")
+        self.assertEqual(str(midi2lily.Duration(Fraction(5, 12))), "3~ 12")
+
+        # unquantized input with a large numerator
+        self.assertEqual(str(midi2lily.Duration.get_duration(1919, 1024, 4)), "4..~ 64......")
+        self.assertEqual(str(midi2lily.Duration.get_duration(2 ** 40 - 1, 2 ** 40, 1)), "2" + "." * 39)
+
+    def test_zero_duration(self):
+        with self.assertRaises(ValueError):
+            str(midi2lily.Duration(Fraction(0)))
+
     def testAFewWholeNotes(self):
         # a few whole notes
         duration = midi2lily.Duration.get_duration(16, 1, 4)
@@ -372,6 +492,45 @@ class LilypondDurationTest(unittest.TestCase):
         # should be rendered as tied 1/4 note durations when crossing the measure
         self.assertEqual(rest.__str__(context), "r4 | r4")
 
+    def test_ticks_on_a_common_grid(self):
+        # durations from midi stay on the grid of ticks_per_beat * denominator
+        quarter = midi2lily.Duration.get_duration(480, 480, 4)
+        eighth = midi2lily.Duration.get_duration(240, 480, 4)
+
+        self.assertEqual(quarter + eighth, midi2lily.Duration(Fraction(3, 8)))
+        self.assertEqual((quarter - eighth).length(), Fraction(1, 8))
+        self.assertEqual(str(quarter + eighth), "4.")
+
+        # mixing grids is still exact
+        self.assertEqual(quarter + midi2lily.Duration(Fraction(1, 3)), midi2lily.Duration(Fraction(7, 12)))
+        self.assertTrue(eighth < midi2lily.Duration(Fraction(1, 4)))
+        self.assertTrue(midi2lily.Position.get_position(960, 480, 4) > quarter)
+
+    def test_durations_are_interned(self):
+        duration = midi2lily.Duration.get_duration(240, 480, 4)
+
+        self.assertIs(duration, midi2lily.Duration.get_duration(240, 480, 4))
+        self.assertIsNot(duration, midi2lily.Duration.get_duration(480, 480, 4))
+
+    def test_formatted_durations_are_cached(self):
+        midi2lily.Duration.format.cache_clear()
+
+        for _ in range(10):
+            self.assertEqual(str(midi2lily.Duration.get_duration(5, 1, 4)), "1~ 4")
+
+        info = midi2lily.Duration.format.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 9)
+
+    def test_position_api(self):
+        position = midi2lily.Position(Fraction(5, 4))
+        self.assertEqual(position.length(), Fraction(5, 4))
+        self.assertEqual(position, midi2lily.Position.get_position(5, 1, 4))
+        self.assertEqual(str(position), "measure 1, beat 1")
+
+        # a position is not a duration
+        self.assertNotEqual(position, midi2lily.Duration(Fraction(5, 4)))
+
 
 class LilypondPitchTest(unittest.TestCase):
 
@@ -385,6 +544,10 @@ class LilypondPitchTest(unittest.TestCase):
         pitch = midi2lily.Pitch(62)
         self.assertEqual(str(pitch), "d'")
 
+    def testPitchPool(self):
+        self.assertIs(midi2lily.Pitch(60), midi2lily.Pitch(60))
+        self.assertFalse(hasattr(midi2lily.Pitch(60), '__dict__'))
+
     def testPitchEquality(self):
         self.assertTrue(midi2lily.Pitch(60) == midi2lily.Pitch(60))
         self.assertTrue(midi2lily.Pitch(60) != midi2lily.Pitch(62))
@@ -419,18 +582,28 @@ class LilypondNoteTest(unittest.TestCase):
         self.assertEqual(str(note), "<c' d'>4")
         
     def testUniquePitchesInChord(self):
-        def testChord(self):
-            pitches = [midi2lily.Pitch(60), midi2lily.Pitch(62), midi2lily.Pitch(62)]
-            duration = midi2lily.Duration.get_duration(1, 1, 4)
-            note = midi2lily.Chord(pitches, duration)
-            self.assertEqual(str(note), "<c' d'>4")
+        pitches = [midi2lily.Pitch(60), midi2lily.Pitch(62), midi2lily.Pitch(62)]
+        duration = midi2lily.Duration.get_duration(1, 1, 4)
+        note = midi2lily.Chord(pitches, duration)
+        self.assertEqual(str(note), "<c' d'>4")
 
     def testPitchesAreSortedWhenPrinted(self):
-        def testChord(self):
-            pitches = [midi2lily.Pitch(62), midi2lily.Pitch(60)]
-            duration = midi2lily.Duration.get_duration(1, 1, 4)
-            note = midi2lily.Chord(pitches, duration)
-            self.assertEqual(str(note), "<c' d'>4")
+        pitches = [midi2lily.Pitch(62), midi2lily.Pitch(60)]
+        duration = midi2lily.Duration.get_duration(1, 1, 4)
+        note = midi2lily.Chord(pitches, duration)
+        self.assertEqual(str(note), "<c' d'>4")
+
+    def testChordMask(self):
+        duration = midi2lily.Duration.get_duration(1, 1, 4)
+        chord = midi2lily.Chord([midi2lily.Pitch(64), midi2lily.Pitch(60)], duration)
+        self.assertEqual(chord.mask, (1 << 60) | (1 << 64))
+        self.assertEqual(chord.pitches, [midi2lily.Pitch(60), midi2lily.Pitch(64)])
+        self.assertEqual(chord.lowest_pitch(), midi2lily.Pitch(60))
+
+        chord = midi2lily.Chord.construct_chord(chord, midi2lily.Note(midi2lily.Pitch(55), duration))
+        self.assertEqual(chord, midi2lily.Chord([midi2lily.Pitch(p) for p in (55, 60, 64)], duration))
+        self.assertEqual(hash(chord), hash(midi2lily.Chord([midi2lily.Pitch(p) for p in (64, 60, 55)], duration)))
+        self.assertEqual(str(chord), "<g c' e'>4")
 
 
 class LilyPondExpressionLengthTest(unittest.TestCase):
@@ -776,6 +949,1049 @@ class HandleMidiNoteTest(BaseTest):
         file = self.build_file(midi_notes, context)
         self.assertEqual(str(file), self.get_expected('test-midi-files/polyphonic6.txt'))
 
+class ScalingTest(BaseTest):
+
+    # a melody of eighth notes with a chord and a rest every measure
+    def melody(self, number_of_notes):
+        midi_notes = []
+        for i in range(number_of_notes):
+            start = i + (i // 8)
+            midi_notes.append(midi2lily.MidiNote(start, start + 1, 60 + i % 12))
+            if i % 8 == 0:
+                midi_notes.append(midi2lily.MidiNote(start, start + 1, 48))
+        return midi_notes
+
+    # a melody with a two voice passage every measure
+    def polyphonic_melody(self, number_of_notes):
+        midi_notes = []
+        for i in range(0, number_of_notes, 8):
+            start = i
+            midi_notes.append(midi2lily.MidiNote(start, start + 2, 60))
+            midi_notes.append(midi2lily.MidiNote(start, start + 1, 64))
+            midi_notes.append(midi2lily.MidiNote(start + 1, start + 2, 67))
+            for j in range(2, 8):
+                midi_notes.append(midi2lily.MidiNote(start + j, start + j + 1, 60 + j))
+        return midi_notes
+
+    # counts how often the span or length of a note, rest or chord is asked
+    # for while the given notes are converted. With cached lengths this work
+    # is proportional to the number of notes
+    def count_length_calls(self, midi_notes):
+        context = midi2lily.ParseContext()
+        context.time_signature = midi2lily.TimeSignature(4, 4)
+        context.ticks_per_beat = 2
+        context.staff = midi2lily.Staff(':1')
+
+        calls = []
+        def counting(original):
+            def method(self):
+                calls.append(self)
+                return original(self)
+            return method
+
+        with mock.patch.object(midi2lily.LeafExpression, 'span', counting(midi2lily.LeafExpression.span)), \
+             mock.patch.object(midi2lily.LeafExpression, 'length', counting(midi2lily.LeafExpression.length)):
+            for midi_note in midi_notes:
+                midi2lily.handle_midi_note(midi_note, context)
+
+        self.assertEqual(context.staff.length(), Fraction(midi_notes[-1].end, 8))
+        return len(calls)
+
+    def test_per_note_cost_is_flat(self):
+        small = self.count_length_calls(self.melody(1000))
+        large = self.count_length_calls(self.melody(8000))
+
+        self.assertGreater(small, 0)
+        self.assertLessEqual(large / 8000, small / 1000 * 1.05)
+
+    def test_polyphonic_per_note_cost_is_flat(self):
+        small = self.count_length_calls(self.polyphonic_melody(1000))
+        large = self.count_length_calls(self.polyphonic_melody(8000))
+
+        self.assertGreater(small, 0)
+        self.assertLessEqual(large / 8000, small / 1000 * 1.05)
+
+class MemoryTest(BaseTest):
+
+    # midi notes of every track of a midi file
+    def read_midi_notes(self, test):
+        midifile = MidiFile(test)
+        tracks = []
+
+        for track in midifile.tracks[1:]:
+            context = midi2lily.ParseContext()
+            context.track = track
+            context.time_signature = midi2lily.TimeSignature(4, 4)
+            context.ticks_per_beat = midifile.ticks_per_beat
+            midi_notes = []
+
+            for msg in track:
+                context.position += msg.time
+                if midi2lily.is_note_on_message(msg):
+                    midi2lily.note_on_handler(msg, context)
+                if midi2lily.is_note_off_message(msg):
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        midi_notes.append(midi2lily.convert_to_midi_note(msg, context))
+
+            tracks.append(midi_notes)
+
+        return midifile.ticks_per_beat, tracks
+
+    def test_bytes_per_note(self):
+        ticks_per_beat, tracks = self.read_midi_notes('test-midi-files/Eine-Kleine-Nachtmusik.mid')
+        scale = 4
+
+        gc.collect()
+        tracemalloc.start()
+
+        staves = []
+        number_of_notes = 0
+        for midi_notes in tracks:
+            context = midi2lily.ParseContext()
+            context.time_signature = midi2lily.TimeSignature(4, 4)
+            context.ticks_per_beat = ticks_per_beat
+            context.staff = midi2lily.Staff()
+
+            # repeat the piece a number of times
+            length = max(midi_note.end for midi_note in midi_notes)
+            for i in range(scale):
+                for midi_note in midi_notes:
+                    midi2lily.handle_midi_note(midi2lily.MidiNote(midi_note.start + i * length, midi_note.end + i * length, midi_note.pitch), context)
+                    number_of_notes += 1
+
+            staves.append(context.staff)
+
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLess(size / number_of_notes, 400)
+
+@unittest.skipIf(midi2lily.numpy is None, "numpy is not installed")
+class ColumnarIngestTest(BaseTest):
+
+    def test_pairing(self):
+        track = MidiTrack()
+        track.append(Message('note_on', note=60, velocity=64, time=0))
+        track.append(Message('note_on', note=64, velocity=64, time=0))
+        track.append(Message('note_off', note=60, velocity=0, time=96))
+        # a second note-on of a sounding pitch restarts it
+        track.append(Message('note_on', note=64, velocity=64, time=96))
+        track.append(Message('note_on', note=64, velocity=0, time=96))
+        # no note-on for this one
+        track.append(Message('note_off', note=60, velocity=0, time=96))
+
+        columns, tick, time_signature = midi2lily.track_columns(track)
+        midi_notes = midi2lily.columnar_midi_notes(columns, tick)
+
+        self.assertIsNone(time_signature)
+        self.assertEqual(list(tick), [0, 0, 96, 192, 288, 384])
+        self.assertEqual(list(midi_notes['start']), [0, 192, 0])
+        self.assertEqual(list(midi_notes['end']), [96, 288, 384])
+        self.assertEqual(list(midi_notes['pitch']), [60, 64, 60])
+        self.assertEqual(list(midi_notes['paired']), [True, True, False])
+
+    def test_same_as_message_walk(self):
+        quantize_duration = midi2lily.Duration(Fraction(1, 16))
+        for test in ['test-midi-files/polyphonic.midi', 'test-midi-files/Eine-Kleine-Nachtmusik.mid']:
+            midifile = MidiFile(test)
+            for duration in [None, quantize_duration]:
+                with warnings.catch_warnings(record=True) as walked:
+                    warnings.simplefilter('always')
+                    expected = str(midi2lily.convert(midifile, duration, vectorized=False))
+                with warnings.catch_warnings(record=True) as paired:
+                    warnings.simplefilter('always')
+                    result = str(midi2lily.convert(midifile, duration, vectorized=True))
+                self.assertEqual(result, expected)
+                self.assertEqual([str(w.message) for w in paired], [str(w.message) for w in walked])
+
+    def test_batch_quantization(self):
+        midi_notes = midi2lily.numpy.zeros(6, dtype=[('start', 'i8'), ('end', 'i8'), ('pitch', 'i2')])
+        midi_notes['start'] = [0, 59, 60, 180, 300, 470]
+        midi_notes['end'] = [100, 61, 130, 200, 420, 530]
+
+        expected = []
+        for start, end in zip(midi_notes['start'].tolist(), midi_notes['end'].tolist()):
+            midi_note = midi2lily.MidiNote(start, end, 60)
+            midi_note.quantize(120)
+            expected.append((midi_note.start, midi_note.end))
+
+        stats = midi2lily.quantize_midi_notes(midi_notes, 120)
+
+        self.assertEqual(list(zip(midi_notes['start'].tolist(), midi_notes['end'].tolist())), expected)
+        self.assertEqual(expected, [(0, 120), (0, 120), (0, 120), (240, 360), (240, 480), (480, 600)])
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(stats.max_error, 160)
+        self.assertEqual(stats.total_error, 20 + 59 + 59 + 60 + 10 + 60 + 160 + 60 + 60 + 10 + 70)
+
+    def test_quantization_stats_per_track(self):
+        midifile = MidiFile('test-midi-files/canon-in-d.midi')
+        quantize_duration = midi2lily.Duration(Fraction(1, 16))
+
+        walked = [staff.quantization for staff in midi2lily.convert(midifile, quantize_duration, vectorized=False).staves()]
+        paired = [staff.quantization for staff in midi2lily.convert(midifile, quantize_duration, vectorized=True).staves()]
+
+        self.assertEqual(len(paired), 4)
+        self.assertEqual([str(stats) for stats in paired], [str(stats) for stats in walked])
+        self.assertEqual(paired[-1].max_error, 0)
+
+    def grid_notes(self, steps, step_ticks, jitter):
+        midi_notes = midi2lily.numpy.zeros(len(steps), dtype=[('start', 'i8'), ('end', 'i8'), ('pitch', 'i2')])
+        midi_notes['start'] = [step * step_ticks + jitter * (i % 3 - 1) for i, step in enumerate(steps)]
+        midi_notes['end'] = midi_notes['start'] + step_ticks - jitter
+        return midi_notes
+
+    def test_choose_quantize_duration(self):
+        # 480 ticks per quarter note in 4/4
+        sixteenths = self.grid_notes(range(64), 120, 7)
+        eighths = self.grid_notes(range(32), 240, 0)
+        triplets = self.grid_notes(range(48), 160, 5)
+
+        self.assertEqual(midi2lily.choose_quantize_duration(sixteenths, 480, 4), midi2lily.Duration(Fraction(1, 16)))
+        self.assertEqual(midi2lily.choose_quantize_duration(eighths, 480, 4), midi2lily.Duration(Fraction(1, 8)))
+        self.assertEqual(midi2lily.choose_quantize_duration(triplets, 480, 4), midi2lily.Duration(Fraction(1, 12)))
+        self.assertIsNone(midi2lily.choose_quantize_duration(eighths[:0], 480, 4))
+
+    def test_auto_quantize(self):
+        midifile = MidiFile('test-midi-files/nachtmusik-phrase-a.midi')
+        result = midi2lily.convert(midifile, midi2lily.AUTO_QUANTIZE)
+
+        grids = [staff.quantize_duration.length() for staff in result.staves()]
+        self.assertEqual(grids, [Fraction(1, 16), Fraction(1, 16), Fraction(1, 16), Fraction(1, 8)])
+        self.assertEqual(str(result), str(midi2lily.convert(midifile)))
+
+        with self.assertRaises(ValueError):
+            midi2lily.convert(midifile, midi2lily.AUTO_QUANTIZE, vectorized=False)
+
+class TrackParallelTest(BaseTest):
+
+    def test_tracks_in_worker_processes(self):
+        midifile = MidiFile('test-midi-files/nachtmusik-phrase-a.midi')
+        result = midi2lily.convert(midifile, jobs=2)
+
+        self.assertEqual(str(result), str(midi2lily.convert(midifile)))
+        self.assertEqual([staff.name() for staff in result.staves()], [track.name for track in midifile.tracks[1:]])
+
+    def test_convert_track(self):
+        midifile = MidiFile('test-midi-files/polyphonic.midi')
+        time_signature = midi2lily.first_time_signature(midifile)
+        staff = midi2lily.convert_track(midifile.tracks[1], time_signature, midifile.ticks_per_beat)
+
+        file = midi2lily.File()
+        file.add(staff)
+        self.assertEqual(str(file), self.get_expected('test-midi-files/polyphonic.txt'))
+
+@unittest.skipIf(midi2lily.numpy is None, "numpy is not installed")
+class SilenceSegmentTest(BaseTest):
+
+    def convert_track(self, midifile, track, segments):
+        context = midi2lily.ParseContext()
+        context.track = track
+        context.staff = midi2lily.Staff(track.name)
+        midi2lily.time_signature_handler(midi2lily.first_time_signature(midifile), context, midifile.ticks_per_beat, None)
+
+        midi_notes = midi2lily.track_midi_notes(track, context, midifile.ticks_per_beat, None)
+        midi2lily.handle_midi_notes_in_segments(midi_notes, context, segments)
+        if context.polyphonic_context:
+            context.polyphonic_context.close()
+
+        file = midi2lily.File()
+        file.add(context.staff)
+        return str(file)
+
+    def parse_context(self, midifile):
+        context = midi2lily.ParseContext()
+        midi2lily.time_signature_handler(midi2lily.first_time_signature(midifile), context, midifile.ticks_per_beat, None)
+        return context
+
+    def test_silence_cuts(self):
+        midi_notes = midi2lily.numpy.zeros(6, dtype=[('start', 'i8'), ('end', 'i8'), ('pitch', 'i2')])
+        midi_notes['start'] = [0, 96, 96, 400, 600, 500]
+        midi_notes['end'] = [96, 192, 480, 480, 700, 700]
+
+        with mock.patch.object(midi2lily, 'MIN_SEGMENT_NOTES', 1):
+            self.assertEqual(midi2lily.silence_cuts(midi_notes, 1), [0])
+            self.assertEqual(midi2lily.silence_cuts(midi_notes, 3), [0, 1, 4])
+        self.assertEqual(midi2lily.silence_cuts(midi_notes, 3), [0])
+
+    def test_same_as_sequential(self):
+        with warnings.catch_warnings(), mock.patch.object(midi2lily, 'MIN_SEGMENT_NOTES', 1):
+            warnings.simplefilter('ignore')
+            for test in glob.glob('test-midi-files/*.mid*'):
+                midifile = MidiFile(test)
+                for track in midifile.tracks[1:]:
+                    expected = self.convert_track(midifile, track, 1)
+                    self.assertEqual(self.convert_track(midifile, track, 4), expected)
+                    self.assertEqual(self.convert_track(midifile, track, 50), expected)
+
+    def test_single_track_in_worker_processes(self):
+        source = MidiFile('test-midi-files/canon-in-d.midi')
+        midifile = MidiFile(ticks_per_beat=source.ticks_per_beat)
+        midifile.tracks.extend(source.tracks[:2])
+
+        with mock.patch.object(midi2lily, 'MIN_SEGMENT_NOTES', 100):
+            self.assertEqual(len(midi2lily.silence_cuts(midi2lily.track_midi_notes(source.tracks[1], self.parse_context(source), source.ticks_per_beat, None), 2)), 2)
+            result = str(midi2lily.convert(midifile, jobs=2))
+
+        self.assertEqual(result, str(midi2lily.convert(midifile)))
+
+class ConversionCacheTest(BaseTest):
+
+    def test_hit_and_miss(self):
+        midifile = MidiFile('test-midi-files/polyphonic.midi')
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory)
+
+            result = midi2lily.convert(midifile, cache=cache)
+            self.assertIsInstance(result, midi2lily.File)
+            cached = midi2lily.convert(midifile, cache=cache)
+            self.assertIsInstance(cached, midi2lily.CachedFile)
+            self.assertEqual(str(cached), str(result))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # other options give another entry
+            midi2lily.convert(midifile, midi2lily.Duration(Fraction(1, 16)), cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory)
+            key = cache.key(b'midi', midi2lily.Duration(Fraction(1, 16)))
+            self.assertEqual(key, cache.key(b'midi', midi2lily.Duration.get_duration(120, 480, 4)))
+            self.assertNotEqual(key, cache.key(b'midi'))
+            self.assertNotEqual(key, cache.key(b'midi', midi2lily.AUTO_QUANTIZE))
+            self.assertNotEqual(key, cache.key(b'other midi', midi2lily.Duration(Fraction(1, 16))))
+            with mock.patch.object(midi2lily, '__version__', 'next'):
+                self.assertNotEqual(key, cache.key(b'midi', midi2lily.Duration(Fraction(1, 16))))
+
+    def test_least_recently_used_are_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory, max_size=25)
+            for i, key in enumerate(['a', 'b']):
+                cache.put(key, "0123456789")
+                os.utime(cache.path(key), ns=(i * 10**9, i * 10**9))
+
+            # reading a marks it as used
+            self.assertEqual(cache.get('a'), "0123456789")
+            cache.put('c', "0123456789")
+
+            self.assertEqual(sorted(os.listdir(directory)), ['a.ly', 'c.ly'])
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_directory_is_scanned_when_too_big(self):
+        with tempfile.TemporaryDirectory() as directory:
+            midi2lily.ConversionCache(directory).put('a', "0123456789")
+            cache = midi2lily.ConversionCache(directory, max_size=35)
+            self.assertEqual(cache.size, 10)
+
+            with mock.patch('os.scandir', side_effect=os.scandir) as scandir:
+                cache.put('b', "0123456789")
+                # replacing an entry does not add its size twice
+                cache.put('b', "0123456789")
+                cache.put('c', "0123456789")
+                self.assertEqual(scandir.call_count, 0)
+
+                cache.put('d', "0123456789")
+                self.assertEqual(scandir.call_count, 1)
+            self.assertEqual(cache.size, 30)
+            self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_failed_write_leaves_no_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory)
+            with self.assertRaises(TypeError):
+                cache.put('a', None)
+            with mock.patch('os.replace', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    cache.put('a', "0123456789")
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(cache.size, 0)
+
+class IncrementalConverterTest(BaseTest):
+
+    def test_unchanged_tracks_are_reused(self):
+        midifile = MidiFile('test-midi-files/nachtmusik-phrase-a.midi')
+        converter = midi2lily.IncrementalConverter()
+
+        self.assertEqual(str(converter.convert(midifile)), str(midi2lily.convert(midifile)))
+        self.assertEqual((converter.converted, converter.reused), (4, 0))
+
+        edited = copy.deepcopy(midifile)
+        note_on = next(msg for msg in edited.tracks[2] if msg.type == 'note_on')
+        note_on.time += 1
+
+        result = str(converter.convert(edited))
+        self.assertEqual(result, str(midi2lily.convert(edited)))
+        self.assertNotEqual(result, str(midi2lily.convert(midifile)))
+        self.assertEqual((converter.converted, converter.reused), (5, 3))
+
+    def test_frozen_staff(self):
+        midifile = MidiFile('test-midi-files/polyphonic.midi')
+        file = midi2lily.convert(midifile)
+        expected = str(file)
+
+        staff = next(file.staves())
+        staff.freeze()
+        with mock.patch.object(midi2lily.CompoundExpression, 'chunks', side_effect=AssertionError):
+            self.assertEqual(str(file), expected)
+
+class SmfReaderTest(BaseTest):
+
+    def events(self, track):
+        tick = 0
+        events = []
+        for msg in track:
+            tick += msg.time
+            if msg.type in ('note_on', 'note_off'):
+                events.append((tick, msg.type, msg.note, msg.velocity))
+            elif msg.type == 'time_signature':
+                events.append((tick, msg.type, msg.numerator, msg.denominator))
+        return events
+
+    # a track named after time has passed
+    def late_name(self):
+        reference = MidiFile()
+        reference.tracks.append(MidiTrack([MetaMessage('time_signature')]))
+        reference.tracks.append(MidiTrack([MetaMessage('text', text='intro', time=0), MetaMessage('track_name', name='Piano', time=1),
+                                           Message('note_on', note=60, time=0), Message('note_off', note=60, time=480)]))
+        buffer = io.BytesIO()
+        reference.save(file=buffer)
+        return buffer.getvalue()
+
+    # mido is the reference
+    def test_same_as_mido(self):
+        files = [(MidiFile(test), midi2lily.SmfFile(test)) for test in glob.glob('test-midi-files/*.mid*')]
+        files.append((MidiFile(file=io.BytesIO(self.late_name())), midi2lily.SmfFile(data=self.late_name())))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for reference, midifile in files:
+                self.assertEqual(midifile.ticks_per_beat, reference.ticks_per_beat)
+                self.assertEqual([track.name for track in midifile.tracks], [track.name for track in reference.tracks])
+                for track, reference_track in zip(midifile.tracks, reference.tracks):
+                    self.assertEqual(self.events(track), self.events(reference_track))
+
+                self.assertEqual(str(midi2lily.convert(midifile)), str(midi2lily.convert(reference)))
+
+    def test_select_name_after_time(self):
+        midifile = midi2lily.SmfFile(data=self.late_name())
+        self.assertIsNone(midifile.tracks[1].leading_name())
+        tracks = midi2lily.select_tracks(midifile, ['Piano'])
+        self.assertEqual([track.name for track in tracks], ['Piano'])
+        self.assertIn('\\new Staff = "Piano"', str(midi2lily.convert_bytes(self.late_name(), tracks=['Piano'])))
+
+    def test_running_status_and_skipped_events(self):
+        track = bytes([
+            0x00, 0xFF, 0x03, 0x04]) + b'lead' + bytes([
+            0x00, 0x90, 0x3C, 0x40,
+            # running status
+            0x10, 0x40, 0x40,
+            # a controller, a sysex and a meta event in between
+            0x08, 0xB0, 0x07, 0x64,
+            0x08, 0xF0, 0x02, 0x01, 0xF7,
+            0x08, 0xFF, 0x51, 0x03, 0x07, 0xA1, 0x20,
+            0x81, 0x00, 0x80, 0x3C, 0x00,
+            0x00, 0xFF, 0x2F, 0x00])
+        data = b'MThd' + bytes([0, 0, 0, 6, 0, 0, 0, 1, 0, 96]) + b'MTrk' + len(track).to_bytes(4, 'big') + track
+
+        midifile = midi2lily.SmfFile(data=data)
+        self.assertEqual(midifile.ticks_per_beat, 96)
+        self.assertEqual(midifile.tracks[0].name, 'lead')
+        self.assertEqual([event for event in midifile.tracks[0] if event.type != 'track_name'], [
+            midi2lily.NoteEvent('note_on', 0, 60, 64),
+            midi2lily.NoteEvent('note_on', 16, 64, 64),
+            midi2lily.NoteEvent('note_off', 24 + 128, 60, 0)])
+
+        track = pickle.loads(pickle.dumps(midifile.tracks[0]))
+        self.assertEqual(list(track), list(midifile.tracks[0]))
+
+    def test_not_a_midi_file(self):
+        with self.assertRaises(OSError):
+            midi2lily.SmfFile('test-midi-files/c.txt')
+
+class ConvertBytesTest(BaseTest):
+
+    def test_buffers(self):
+        filename = 'test-midi-files/polyphonic.midi'
+        expected = str(midi2lily.convert(MidiFile(filename)))
+        with open(filename, 'rb') as midi:
+            data = midi.read()
+            buffer = mmap.mmap(midi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        for source in [data, bytearray(data), memoryview(data), buffer]:
+            self.assertEqual(str(midi2lily.convert_bytes(source)), expected)
+
+        # parsed in place
+        self.assertIs(midi2lily.SmfFile(data=data).data.obj, data)
+        buffer.close()
+
+    def test_cache_key_without_copy(self):
+        with open('test-midi-files/rests.midi', 'rb') as midi:
+            data = midi.read()
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory)
+            first = midi2lily.convert_bytes(data, cache=cache)
+            # same key as for the file read from disk
+            result = midi2lily.convert(midi2lily.SmfFile('test-midi-files/rests.midi'), cache=cache)
+            self.assertIsInstance(result, midi2lily.CachedFile)
+            self.assertEqual(str(result), str(first))
+
+class ConvertManyTest(BaseTest):
+
+    files = ['test-midi-files/rests.midi', 'test-midi-files/polyphonic.midi', 'test-midi-files/scale.midi']
+
+    def test_results_in_input_order(self):
+        with open(self.files[1], 'rb') as midi:
+            data = midi.read()
+        inputs = [self.files[0], data, MidiFile(self.files[2])]
+
+        stats = midi2lily.BatchStats()
+        results = midi2lily.convert_many(inputs, stats=stats)
+        # lazy: nothing is converted before the first result is asked for
+        self.assertEqual(stats.files, 0)
+
+        results = [str(result) for result in results]
+        self.assertEqual(results, [str(midi2lily.convert(MidiFile(file))) for file in self.files])
+        self.assertEqual(stats.files, 3)
+        self.assertEqual(stats.failures, 0)
+        self.assertEqual(stats.staves, 3)
+        # rests, the notes of polyphonic.midi (all in voices) and scale
+        self.assertEqual(stats.notes, 5 + 3 + 8)
+
+    def test_notes_in_voices(self):
+        for jobs in [1, 2]:
+            stats = midi2lily.BatchStats()
+            list(midi2lily.convert_many(['test-midi-files/polyphonic.midi'], jobs=jobs, stats=stats))
+            self.assertEqual(stats.notes, 3)
+
+    def test_failures(self):
+        stats = midi2lily.BatchStats()
+        inputs = [self.files[0], b'not midi', self.files[2]]
+
+        results = list(midi2lily.convert_many(inputs, stats=stats, return_exceptions=True))
+        self.assertIsInstance(results[1], OSError)
+        self.assertEqual(str(results[2]), str(midi2lily.convert(MidiFile(self.files[2]))))
+        self.assertEqual((stats.files, stats.failures), (3, 1))
+
+        with self.assertRaises(OSError):
+            list(midi2lily.convert_many(inputs))
+
+    def test_cache_hits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = midi2lily.ConversionCache(directory)
+            stats = midi2lily.BatchStats()
+            list(midi2lily.convert_many(self.files, cache=cache, stats=stats))
+            list(midi2lily.convert_many(self.files, cache=cache, stats=stats))
+            self.assertEqual((stats.files, stats.cache_hits), (6, 3))
+            self.assertIn("3 from the cache", str(stats))
+
+    def test_jobs(self):
+        results = [str(result) for result in midi2lily.convert_many(self.files * 3, jobs=2)]
+        self.assertEqual(results, [str(midi2lily.convert(MidiFile(file))) for file in self.files * 3])
+
+class TrackSelectionTest(BaseTest):
+
+    def test_select_by_number_and_name(self):
+        midifile = midi2lily.SmfFile('test-midi-files/nachtmusik-intro.midi')
+        tracks = midi2lily.select_tracks(midifile, [3, 'Violin I'])
+        self.assertEqual([track.name for track in tracks], ['Violin I', 'Viola'])
+        self.assertEqual(midi2lily.parse_track_selection("3, Violin I"), [3, 'Violin I'])
+
+        with self.assertRaises(ValueError):
+            midi2lily.select_tracks(midifile, [7])
+
+        # the control track has no notes
+        with self.assertRaises(ValueError):
+            midi2lily.select_tracks(midifile, [0])
+        with self.assertRaises(ValueError):
+            midi2lily.convert(MidiFile('test-midi-files/scale.midi'), tracks=[0, 1])
+
+    def test_unselected_tracks_are_not_decoded(self):
+        midifile = midi2lily.SmfFile('test-midi-files/nachtmusik-intro.midi')
+        decoded = set()
+        iterate = midi2lily.SmfTrack.__iter__
+
+        def counting(track):
+            decoded.add(midifile.tracks.index(track))
+            return iterate(track)
+
+        with mock.patch.object(midi2lily.SmfTrack, '__iter__', counting):
+            result = midi2lily.convert(midifile, tracks=[2])
+
+        self.assertEqual([staff.name() for staff in result.staves()], ['Violin II'])
+        self.assertEqual(decoded, {0, 2})
+
+    def test_tracks_without_a_name_are_not_decoded(self):
+        def chunk(data):
+            return b'MTrk' + len(data).to_bytes(4, 'big') + data
+
+        end = b'\x00\xff\x2f\x00'
+        control = chunk(end)
+        # named, in 3/4
+        first = chunk(b'\x00\xff\x03\x01a' + b'\x00\xff\x58\x04\x03\x02\x18\x08' + b'\x00\x90\x3c\x40' + b'\x83\x60\x80\x3c\x00' + end)
+        # no name, the channel setup, a note and then a broken event
+        second = chunk(b'\x00\xc0\x05' + b'\x00\x90\x3c\x40' + b'\x00\xff')
+        data = b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big') + (3).to_bytes(2, 'big') + (480).to_bytes(2, 'big') + control + first + second
+
+        midifile = midi2lily.SmfFile(data=data)
+        self.assertIsNone(midifile.tracks[2].leading_name())
+        tracks = midi2lily.select_tracks(midifile, ['a'])
+        self.assertEqual(midi2lily.first_time_signature(midifile, tracks).numerator, 3)
+        self.assertTrue(str(midi2lily.convert(midifile, tracks=['a'])).endswith("c4 }"))
+
+        with self.assertRaises(IndexError):
+            midi2lily.convert(midifile)
+
+class StreamingTest(BaseTest):
+
+    def stream(self, midifile, quantize_duration=None):
+        output = io.StringIO()
+        midi2lily.convert_streaming(midifile, output, quantize_duration)
+        return output.getvalue()
+
+    def without_clefs(self, text):
+        return re.sub(r'\\clef \w+\n', '', text)
+
+    def test_same_as_convert(self):
+        quantize_duration = midi2lily.Duration(Fraction(1, 16))
+        for test in ['test-midi-files/canon-in-d.midi', 'test-midi-files/polyphonic.midi', 'test-midi-files/rests.midi']:
+            midifile = midi2lily.SmfFile(test)
+            self.assertEqual(self.stream(midifile), str(midi2lily.convert(midifile)))
+            self.assertEqual(self.stream(midifile, quantize_duration), str(midi2lily.convert(midifile, quantize_duration)))
+
+    def test_clef_for_every_part(self):
+        midifile = midi2lily.SmfFile('test-midi-files/nachtmusik-phrase-b.midi')
+        result = self.stream(midifile)
+        self.assertEqual(self.without_clefs(result), self.without_clefs(str(midi2lily.convert(midifile))))
+        self.assertIn("\\clef bass\n", result)
+        self.assertIn("\\clef treble\n", result)
+
+    def test_parts_are_written_while_converting(self):
+        midifile = MidiFile('test-midi-files/canon-in-d.midi')
+        track = midifile.tracks[1]
+        stream = midi2lily.StaffStream(track, midi2lily.TimeSignature(4, 4), midifile.ticks_per_beat)
+
+        written = []
+        for msg in track:
+            written.append(len("".join(stream.message(msg))))
+        "".join(stream.close())
+
+        self.assertGreater(stream.parts, 10)
+        self.assertGreater(sum(written[:len(written) // 2]), 0)
+
+    def test_bounded_memory(self):
+        source = MidiFile('test-midi-files/Eine-Kleine-Nachtmusik.mid')
+
+        def peak(scale):
+            midifile = MidiFile(ticks_per_beat=source.ticks_per_beat)
+            midifile.tracks.append(source.tracks[0])
+            track = MidiTrack()
+            for i in range(scale):
+                track.extend(source.tracks[3])
+            midifile.tracks.append(track)
+
+            # throws the output away
+            writer = mock.Mock(spec=['write'])
+            writer.write = len
+
+            tracemalloc.start()
+            midi2lily.convert_streaming(midifile, writer)
+            size = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return size
+
+        # fill the caches first
+        peak(1)
+        self.assertLess(peak(8), 1.5 * peak(2))
+
+class LiveConverterTest(BaseTest):
+
+    def test_running_status(self):
+        parser = midi2lily.MidiByteParser()
+        # note on, running status, a clock byte inside a message, split over two calls
+        messages = list(parser.feed(bytes([0x90, 60, 100, 62, 0xF8, 100, 0x80])))
+        messages += list(parser.feed(bytes([60, 0, 0xF0, 1, 2, 0xF7, 64, 0xB0, 7, 100])))
+        self.assertEqual(messages, [(0x90, [60, 100]), (0x90, [62, 100]), (0x80, [60, 0]), (0xB0, [7, 100])])
+
+    def test_same_as_convert(self):
+        midifile = MidiFile('test-midi-files/canon-in-d.midi')
+        track = midifile.tracks[1]
+        expected = MidiFile(ticks_per_beat=midifile.ticks_per_beat)
+        expected.tracks.extend(midifile.tracks[:2])
+
+        output = io.StringIO()
+        converter = midi2lily.LiveConverter(output, name=track.name, tempo=120, ticks_per_beat=midifile.ticks_per_beat, start=0)
+        ticks = 0
+        written = []
+        for msg in track:
+            ticks += msg.time
+            if not msg.is_meta:
+                converter.feed(bytes(msg.bytes()), ticks / midifile.ticks_per_beat / 2)
+                written.append(len(output.getvalue()))
+        converter.close()
+
+        self.assertEqual(output.getvalue(), str(midi2lily.convert(expected)))
+        # measures are written while playing
+        self.assertGreater(written[len(written) // 2], 100)
+
+        percentiles = converter.latency_percentiles()
+        self.assertEqual(list(percentiles), [50, 90, 99])
+        self.assertLessEqual(percentiles[50], percentiles[99])
+
+    def test_notes_arriving_together(self):
+        output = io.StringIO()
+        converter = midi2lily.LiveConverter(output)
+        converter.feed(bytes([0x90, 60, 100, 60, 0]), 1.0)
+        converter.close()
+        self.assertIn("c", output.getvalue())
+
+    def test_measures_are_written_while_the_player_pauses(self):
+        output = io.StringIO()
+        converter = midi2lily.LiveConverter(output, start=0)
+        # a half note, then nothing
+        converter.feed(bytes([0x90, 60, 100]), 0)
+        converter.feed(bytes([0x80, 60, 0]), 1.0)
+        written = output.getvalue()
+
+        converter.tick(1.5)
+        self.assertEqual(output.getvalue(), written)
+        # the measure is over
+        converter.tick(2.1)
+        self.assertEqual(output.getvalue()[len(written):], "c2 r |\n")
+
+        # the next note continues after the measure that was written
+        converter.feed(bytes([0x90, 62, 100]), 2.5)
+        converter.feed(bytes([0x80, 62, 0]), 3.0)
+        converter.close()
+        self.assertTrue(output.getvalue().endswith("c2 r |\nr4 d }"))
+
+    def test_quantized_notes_can_not_start_before_written_measures(self):
+        output = io.StringIO()
+        converter = midi2lily.LiveConverter(output, quantize_duration=midi2lily.Duration(Fraction(1, 4)), start=0)
+        converter.feed(bytes([0x90, 60, 100]), 0)
+        converter.feed(bytes([0x80, 60, 0]), 1.0)
+        written = output.getvalue()
+        # a note at 2.1s could still be quantized to 2s
+        converter.tick(2.1)
+        self.assertEqual(output.getvalue(), written)
+        converter.tick(2.6)
+        self.assertNotEqual(output.getvalue(), written)
+
+    def test_run_from_socket(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(bytes([0x90, 60, 100, 0x80, 60, 0]))
+            sender.shutdown(socket.SHUT_WR)
+
+            converter = midi2lily.LiveConverter(io.StringIO())
+            converter.run(receiver)
+            self.assertEqual(len(converter.latencies), 2)
+
+class ConversionServerTest(BaseTest):
+
+    files = ['test-midi-files/rests.midi', 'test-midi-files/polyphonic.midi', 'test-midi-files/scale.midi']
+
+    def request(self, request_id, file, **options):
+        with open(file, 'rb') as midi:
+            request = dict(options, id=request_id, midi=base64.b64encode(midi.read()).decode())
+        return json.dumps(request).encode() + b"\n"
+
+    def exchange(self, requests, **options):
+        async def run():
+            server = midi2lily.ConversionServer(**options)
+            await server.start()
+            try:
+                reader, writer = await asyncio.open_connection(*server.address())
+                # all requests are sent before reading any response
+                writer.write(b"".join(requests))
+                writer.write_eof()
+                responses = [json.loads(line) for line in (await reader.read()).splitlines()]
+                writer.close()
+                return responses
+            finally:
+                await server.close()
+
+        return asyncio.run(run())
+
+    def test_responses_in_request_order(self):
+        # a queue of one makes the connection wait for the workers
+        responses = self.exchange([self.request(i, file) for i, file in enumerate(self.files * 2)], queue_size=1)
+        self.assertEqual([response["id"] for response in responses], list(range(6)))
+        self.assertEqual([response["lilypond"] for response in responses],
+                         [str(midi2lily.convert(MidiFile(file))) for file in self.files * 2])
+
+    def test_options(self):
+        responses = self.exchange([self.request("q", 'test-midi-files/canon-in-d.midi', quantize="16", tracks=[1])])
+        midifile = midi2lily.SmfFile('test-midi-files/canon-in-d.midi')
+        self.assertEqual(responses[0]["lilypond"], str(midi2lily.convert(midifile, midi2lily.Duration(Fraction(1, 16)), tracks=[1])))
+
+    def test_errors(self):
+        requests = [b"not json\n", json.dumps({"id": 1, "midi": base64.b64encode(b"not midi").decode()}).encode() + b"\n", self.request(2, self.files[0])]
+        responses = self.exchange(requests)
+        self.assertIn("bad request", responses[0]["error"])
+        self.assertEqual(responses[1]["id"], 1)
+        self.assertIn("MThd", responses[1]["error"])
+        self.assertIn("lilypond", responses[2])
+
+    def test_request_too_long(self):
+        responses = self.exchange([self.request(1, self.files[0])], max_request_size=100)
+        self.assertIn("longer than 100 bytes", responses[0]["error"])
+
+    def test_metrics(self):
+        with mock.patch.object(midi2lily, 'metrics', midi2lily.Metrics()):
+            responses = self.exchange([self.request(1, self.files[1]), b'{"id": 2, "metrics": "json"}\n'])
+        exported = json.loads(responses[1]["metrics"])
+        # counted in the worker process
+        self.assertEqual(exported['counters']['files'], 1)
+        self.assertGreater(exported['counters']['notes'], 0)
+        self.assertEqual(exported['counters']['requests'], 2)
+
+    def test_client_that_does_not_read(self):
+        request = self.request(1, 'test-midi-files/Eine-Kleine-Nachtmusik.mid')
+
+        async def run():
+            server = midi2lily.ConversionServer(jobs=1, queue_size=2)
+            await server.start()
+            # small socket buffers, so the server notices the client is not reading
+            for listening in server.server.sockets:
+                listening.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+            try:
+                client = socket.socket()
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                client.setblocking(False)
+                await asyncio.get_running_loop().sock_connect(client, server.address())
+                reader, writer = await asyncio.open_connection(sock=client)
+                writer.write(request * 40)
+
+                # wait until no more files are converted
+                converted = -1
+                while converted != midi2lily.metrics.counters['files']:
+                    converted = midi2lily.metrics.counters['files']
+                    await asyncio.sleep(1)
+                writer.close()
+                return converted
+            finally:
+                await server.close()
+
+        with mock.patch.object(midi2lily, 'metrics', midi2lily.Metrics()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            converted = asyncio.run(run())
+        # the queues, the worker, the response being written and the socket buffers
+        self.assertLessEqual(converted, 10)
+
+    def test_timeout_does_not_delay_later_requests(self):
+        source = MidiFile('test-midi-files/Eine-Kleine-Nachtmusik.mid')
+        slow = MidiFile(ticks_per_beat=source.ticks_per_beat)
+        slow.tracks.append(source.tracks[0])
+        track = MidiTrack()
+        for i in range(12):
+            track.extend(source.tracks[3])
+        slow.tracks.append(track)
+        buffer = io.BytesIO()
+        slow.save(file=buffer)
+
+        requests = [json.dumps({"id": 0, "midi": base64.b64encode(buffer.getvalue()).decode()}).encode() + b"\n"]
+        requests += [self.request(i, self.files[2]) for i in range(1, 7)]
+        responses = self.exchange(requests, jobs=1, timeout=0.3)
+
+        self.assertIn("timed out", responses[0]["error"])
+        self.assertEqual([response["lilypond"] for response in responses[1:]], [str(midi2lily.convert(MidiFile(self.files[2])))] * 6)
+
+    def test_timeout(self):
+        responses = self.exchange([self.request(1, 'test-midi-files/Eine-Kleine-Nachtmusik.mid')], timeout=0.001)
+        self.assertIn("timed out", responses[0]["error"])
+
+class MetricsTest(BaseTest):
+
+    def setUp(self):
+        patcher = mock.patch.object(midi2lily, 'metrics', midi2lily.Metrics())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def count(self, midifile, **options):
+        with mock.patch.object(midi2lily, 'metrics', midi2lily.Metrics()) as metrics:
+            midi2lily.convert(midifile, **options)
+        return metrics.counters
+
+    def test_counters(self):
+        counters = self.count(MidiFile('test-midi-files/chords.midi'))
+        self.assertEqual((counters['files'], counters['notes'], counters['chords']), (1, 12, 8))
+        self.assertEqual((counters['polyphonic_contexts'], counters['quantize_adjustments']), (0, 0))
+
+        counters = self.count(MidiFile('test-midi-files/polyphonic.midi'))
+        self.assertEqual((counters['notes'], counters['polyphonic_contexts'], counters['voices']), (3, 1, 2))
+
+        midi2lily.convert(MidiFile('test-midi-files/canon-in-d.midi'))
+        self.assertEqual(self.metrics.to_dict()['stages']['track']['count'], len(MidiFile('test-midi-files/canon-in-d.midi').tracks) - 1)
+        self.assertEqual(self.metrics.to_dict()['stages']['convert']['count'], 1)
+
+    @unittest.skipIf(midi2lily.numpy is None, "numpy is not installed")
+    def test_same_counts_on_every_path(self):
+        midifile = midi2lily.SmfFile('test-midi-files/Eine-Kleine-Nachtmusik.mid')
+        quantize_duration = midi2lily.Duration(Fraction(1, 16))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            counters = self.count(midifile, quantize_duration=quantize_duration, vectorized=False)
+            self.assertEqual(self.count(midifile, quantize_duration=quantize_duration, vectorized=True), counters)
+            # counted in worker processes
+            self.assertEqual(self.count(midifile, quantize_duration=quantize_duration, jobs=2), counters)
+
+        for name in ['chords', 'polyphonic_contexts', 'quantize_adjustments', 'warnings']:
+            self.assertGreater(counters[name], 0)
+
+    def test_warnings(self):
+        midifile = MidiFile()
+        midifile.tracks.append(MidiTrack([MetaMessage('time_signature')]))
+        midifile.tracks.append(MidiTrack([Message('note_off', note=60, time=10)]))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            midi2lily.convert(midifile, vectorized=False)
+        self.assertEqual(self.metrics.counters['warnings'], 1)
+
+    def test_histogram(self):
+        for seconds in [0.0005, 0.003, 0.003, 20]:
+            self.metrics.observe('render', seconds)
+
+        histogram = self.metrics.to_dict()['stages']['render']
+        self.assertEqual(histogram['buckets']['0.001'], 1)
+        self.assertEqual(histogram['buckets']['0.005'], 3)
+        self.assertEqual(histogram['buckets']['10'], 3)
+        self.assertEqual(histogram['buckets']['+Inf'], 4)
+        self.assertEqual(histogram['count'], 4)
+        self.assertAlmostEqual(histogram['sum'], 20.0065)
+
+    def test_export(self):
+        midi2lily.convert(MidiFile('test-midi-files/chords.midi'))
+
+        text = self.metrics.to_prometheus()
+        self.assertIn("# TYPE midi2lily_chords_total counter\n", text)
+        self.assertIn("midi2lily_files_total 1\n", text)
+        self.assertIn('midi2lily_stage_seconds_count{stage="convert"} 1\n', text)
+        for line in text.splitlines():
+            self.assertRegex(line, r'^(# (HELP|TYPE) .*|midi2lily_\w+(\{[^}]*\})? [0-9.e+-]+)$')
+
+        exported = json.loads(self.metrics.to_json())
+        self.assertEqual(exported['counters'], self.metrics.counters)
+        self.assertEqual(exported['stages']['convert']['count'], 1)
+
+    def test_merge(self):
+        other = midi2lily.Metrics()
+        other.count('notes', 3)
+        other.observe('track', 0.002)
+        self.metrics.count('notes', 2)
+        self.metrics.observe('track', 0.5)
+        self.metrics.merge(pickle.loads(pickle.dumps(other)))
+        self.assertEqual(self.metrics.counters['notes'], 5)
+        self.assertEqual(self.metrics.to_dict()['stages']['track']['count'], 2)
+
+class CommandLineTest(BaseTest):
+
+    files = ['test-midi-files/c.midi', 'test-midi-files/scale.midi', 'test-midi-files/chords.midi']
+
+    def run_main(self, argv):
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout, mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            status = midi2lily.main(argv)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_stdout_in_input_order(self):
+        status, sequential, _ = self.run_main(self.files)
+        self.assertEqual(status, 0)
+        self.assertEqual(sequential, "".join(str(midi2lily.convert(MidiFile(file))) + "\n" for file in self.files))
+
+        status, parallel, stderr = self.run_main(['-j', '2'] + self.files)
+        self.assertEqual(status, 0)
+        self.assertEqual(parallel, sequential)
+        self.assertIn("files/sec", stderr)
+
+    def test_single_process_renders_to_stdout(self):
+        # no text of a whole file is built
+        with mock.patch.object(midi2lily, 'render', side_effect=AssertionError):
+            status, stdout, _ = self.run_main(self.files)
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, "".join(str(midi2lily.convert(MidiFile(file))) + "\n" for file in self.files))
+
+    def test_files_in_flight_are_bounded(self):
+        in_flight = []
+
+        # runs every file when submitted, counts the results not taken yet
+        class Executor:
+            def __init__(self, jobs):
+                self.pending = 0
+
+            def submit(executor, function, *args):
+                future = concurrent.futures.Future()
+                future.set_result(function(*args))
+                executor.pending += 1
+                in_flight.append(executor.pending)
+                taken = future.result
+                def result():
+                    executor.pending -= 1
+                    return taken()
+                future.result = result
+                return future
+
+            def shutdown(self):
+                pass
+
+        with mock.patch('concurrent.futures.ProcessPoolExecutor', Executor):
+            status, stdout, _ = self.run_main(['-j', '2'] + self.files * 4)
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, "".join(str(midi2lily.convert(MidiFile(file))) + "\n" for file in self.files * 4))
+        self.assertEqual(max(in_flight), 5)
+
+    def test_failures_are_isolated(self):
+        status, stdout, stderr = self.run_main(['-j', '2', 'test-midi-files/c.midi', 'test-midi-files/c.txt', 'test-midi-files/scale.midi'])
+        self.assertEqual(status, 1)
+        self.assertEqual(stdout, str(midi2lily.convert(MidiFile('test-midi-files/c.midi'))) + "\n" + str(midi2lily.convert(MidiFile('test-midi-files/scale.midi'))) + "\n")
+        self.assertIn("test-midi-files/c.txt: failed", stderr)
+        self.assertIn("converted 2 of 3 files", stderr)
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(midi2lily, 'metrics', midi2lily.Metrics()):
+            filename = os.path.join(directory, 'metrics.json')
+            self.run_main(['-j', '2', '--metrics', filename] + self.files)
+            with open(filename) as metrics:
+                exported = json.load(metrics)
+            self.assertEqual(exported['counters']['files'], 3)
+            self.assertGreater(exported['counters']['chords'], 0)
+
+    def test_outputs_with_the_same_name(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other = os.path.join(directory, 'in')
+            os.makedirs(other)
+            shutil.copy('test-midi-files/c.midi', os.path.join(other, 'scale.mid'))
+            output = os.path.join(directory, 'out')
+
+            files = ['test-midi-files/scale.midi', 'test-midi-files/chords.midi', os.path.join(other, 'scale.mid'), 'test-midi-files/c.midi', 'test-midi-files/c.midi']
+            status, stdout, stderr = self.run_main(['-j', '2', '-o', output] + files)
+
+            self.assertEqual(status, 1)
+            self.assertIn("converted 1 of 5 files", stderr)
+            self.assertIn("test-midi-files/scale.midi: failed: scale.ly would also be written for {}\n".format(os.path.join(other, 'scale.mid')), stderr)
+            self.assertIn("test-midi-files/c.midi: failed: c.ly would also be written for test-midi-files/c.midi\n", stderr)
+            self.assertEqual(os.listdir(output), ['chords.ly'])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            status, first, stderr = self.run_main(['--cache', directory] + self.files)
+            self.assertIn("0 from the cache", stderr)
+            status, second, stderr = self.run_main(['-j', '2', '--cache', directory] + self.files)
+            self.assertIn("3 from the cache", stderr)
+            self.assertEqual(second, first)
+
+    def test_output_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            status, stdout, _ = self.run_main(['-o', directory] + self.files)
+            self.assertEqual(status, 0)
+            self.assertEqual(stdout, "")
+            self.assertEqual(sorted(os.listdir(directory)), ['c.ly', 'chords.ly', 'scale.ly'])
+            with open(os.path.join(directory, 'scale.ly')) as output:
+                self.assertEqual(output.read(), str(midi2lily.convert(MidiFile('test-midi-files/scale.midi'))) + "\n")
+
 class EndToEndTests(BaseTest):
 
     def test_c(self):